@@ -7,6 +7,7 @@ import os
 
 import db
 import config
+import orbit.db
 
 #  FIXME: if you are reading this in the year 9999...
 far_future = 253401417420
@@ -93,6 +94,7 @@ def create(assignment, initial, peer_review, final):
                              final_due_date=final)
     except db.peewee.IntegrityError:
         errx('cannot create assignment with duplicate name')
+    orbit.db.DashboardRow.add_assignment(assignment, initial, final)
 
 
 def dummy(assignment):
@@ -103,6 +105,7 @@ def dummy(assignment):
                              final_due_date=far_future)
     except db.peewee.IntegrityError:
         errx('cannot create assignment with duplicate name')
+    orbit.db.DashboardRow.add_assignment(assignment, far_future, far_future)
 
 
 def alter(assignment, initial, peer_review, final):
@@ -120,6 +123,9 @@ def alter(assignment, initial, peer_review, final):
              .where(db.Assignment.name == assignment))
     if query.execute() < 1:
         errx(f'no such assignment {assignment}')
+    asn = db.Assignment.get(db.Assignment.name == assignment)
+    orbit.db.DashboardRow.set_due_dates(assignment, asn.initial_due_date,
+                                        asn.final_due_date)
 
 
 def remove(assignment):
@@ -128,6 +134,8 @@ def remove(assignment):
              .where(db.Assignment.name == assignment))
     if query.execute() < 1:
         errx(f'no such assignment {assignment}')
+    dash_tbl = orbit.db.DashboardRow
+    dash_tbl.delete().where(dash_tbl.assignment == assignment).execute()
 
 
 def dump(fmt_iso):
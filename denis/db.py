@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import peewee
 
+import sqlitedb
+
 DB_PATH = '/var/lib/denis/assignments.db'
-DB = peewee.SqliteDatabase(DB_PATH)
+DB = sqlitedb.Database(DB_PATH)
 
 
 class BaseModel(peewee.Model):
@@ -27,6 +29,19 @@ class PeerReviewAssignment(BaseModel):
     class Meta:
         indexes = ((('assignment', 'reviewer'), True),)
 
+    @classmethod
+    def of(cls, assignment, reviewer):
+        return cls.select().where((cls.assignment == assignment) &
+                                  (cls.reviewer == reviewer))
+
+
+# Schema changes made since the first deployment, see sqlitedb.migrate
+MIGRATIONS = []
+
+
+def migrate():
+    return sqlitedb.migrate(DB, BaseModel.__subclasses__(), MIGRATIONS)
+
 
 if __name__ == '__main__':
-    DB.create_tables(BaseModel.__subclasses__())
+    print('assignments.db schema version {} -> {}'.format(*migrate()))
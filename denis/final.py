@@ -9,7 +9,7 @@ assignment = sys.argv[1]
 
 usernames_to_subs = utilities.user_to_sub(assignment, 'final')
 
-for oopsie in orbit.db.Oopsie.select().where(orbit.db.Oopsie.assignment == assignment):
+for oopsie in orbit.db.Oopsie.spent_on(assignment):
     if usernames_to_subs[oopsie.user] is not None:
         os.system(f'restrict_access /var/lib/email/journal/journal -a {oopsie.user}')
 
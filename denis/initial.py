@@ -5,6 +5,7 @@ import random
 import sys
 
 import db
+import orbit.db
 import utilities
 
 # this is passed from start.py via run-at
@@ -53,6 +54,13 @@ try:
 except db.peewee.IntegrityError as e:
     print(e)
 
+asn = db.Assignment.get(db.Assignment.name == assignment)
+for peers in (db.PeerReviewAssignment.select()
+              .where(db.PeerReviewAssignment.assignment == assignment)):
+    orbit.db.DashboardRow.upsert(peers.reviewer, assignment,
+                                 asn.initial_due_date, asn.final_due_date,
+                                 peer1=peers.reviewee1, peer2=peers.reviewee2)
+
 
 utilities.release_subs([sub.submission_id for sub in usernames_to_subs.values() if sub])
 
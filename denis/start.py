@@ -7,6 +7,8 @@ import sys
 
 import db
 import config
+import sqlitedb
+import orbit.db
 
 from configure import far_future
 
@@ -50,6 +52,8 @@ def handle_trigger(info):
     # update relevant deadline to current time so that dashboard etc behaves as expected
     setattr(asn, attr, int(datetime.datetime.now().timestamp()))
     asn.save()
+    orbit.db.DashboardRow.set_due_dates(asn.name, asn.initial_due_date,
+                                        asn.final_due_date)
     subprocess.Popen([program, asn.name]).wait()
 
 
@@ -63,6 +67,11 @@ def main():
     signal.signal(signal.SIGUSR1, signal_handler)
     signal.signal(signal.SIGRTMIN, signal_handler)
 
+    # bring a database from an older release up to date
+    db.migrate()
+    # and keep it open for the services that mount it read-only
+    sqlitedb.hold(db.DB)
+
     # create reload file
     open(config.RELOAD_FILE, 'w').close()
 
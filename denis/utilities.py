@@ -3,30 +3,25 @@ import git
 import subprocess
 import tempfile
 
+import db
 import orbit.db
 import mailman.db
+import sqlitedb
 
 
 PUSH_URL = 'http://git:8000/cgi-bin/git-receive-pack/grading.git'
 PULL_URL = 'http://git:8000/grading.git'
 REMOTE_NAME = 'grading'
 
+cross = sqlitedb.Attached(orbit.db, mailman=mailman.db, denis=db)
 
+
+# Get the latest gradeable of each user for a component, or None
 def user_to_sub(assignment, component):
-    submission_ids = {}
-    grd_tbl = mailman.db.Gradeable
-    relevant_gradeables = (grd_tbl.select()
-                           .where(grd_tbl.assignment == assignment)
-                           .where(grd_tbl.component == component)
-                           .order_by(-grd_tbl.timestamp))
-    for user in orbit.db.User.select():
-        username = user.username
-        sub = (relevant_gradeables
-               .where(grd_tbl.user == username)
-               .first())
-        submission_ids[user.username] = sub if sub else None
-
-    return submission_ids
+    query = cross.Gradeable.latest_of_each_user(cross.User, assignment,
+                                                component)
+    return {gbl.username: gbl if gbl.id is not None else None
+            for gbl in query}
 
 
 def release_subs(sub_ids):
@@ -46,11 +41,7 @@ def configure_repo(repo):
 
 
 def update_tags(assignment, component):
-    grd_tbl = mailman.db.Gradeable
-    gbls = (grd_tbl.select()
-                   .order_by(-grd_tbl.timestamp)
-                   .where(grd_tbl.assignment == assignment)
-                   .where(grd_tbl.component == component))
+    usernames_to_subs = user_to_sub(assignment, component)
     with tempfile.TemporaryDirectory() as repo_path:
         repo = git.Repo.clone_from(PULL_URL, repo_path)
         repo.create_remote(REMOTE_NAME, PUSH_URL)
@@ -60,14 +51,13 @@ def update_tags(assignment, component):
             repo.create_tag('EMPTY')
 
         updated_tags = []
-        for user in orbit.db.User.select():
-            new_tag_name = f'{assignment}_{component}_{user.username}'
+        for username, user_gbl in usernames_to_subs.items():
+            new_tag_name = f'{assignment}_{component}_{username}'
             updated_tags.append(new_tag_name)
             if new_tag_name in repo.tags:
                 print('Potential issue? Attempted to create duplicate tag '
                       f'{new_tag_name}')
                 continue
-            user_gbl = gbls.where(grd_tbl.user == user.username).first()
             if not user_gbl or (id := user_gbl.submission_id) not in repo.tags:
                 msg = 'No gradeable submission'
                 to_promote = repo.tags['EMPTY']
@@ -146,11 +136,7 @@ def check_subject_tag(repo, tag):
 
     commits = repo.git.execute(['git', 'rev-list', '--reverse', tag]).split('\n')
 
-    sub_tbl = mailman.db.Submission
-    relevant_submissions = (sub_tbl.select()
-                            .where(sub_tbl.recipient == assignment)
-                            .where(sub_tbl.user == user)
-                            .order_by(sub_tbl.timestamp.desc()))
+    relevant_submissions = mailman.db.Submission.sent_to(assignment, user)
     expected_revision_number = relevant_submissions.count()
 
     nr_commits = len(commits)
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
+import argparse
 import peewee
+import signal
 
-DB = peewee.SqliteDatabase("/var/lib/mailman/submissions.db")
+import sqlitedb
+
+DB = sqlitedb.Database("/var/lib/mailman/submissions.db")
 
 
 class BaseModel(peewee.Model):
@@ -20,6 +24,31 @@ class Submission(BaseModel):
     in_reply_to = peewee.TextField(null=True)
     status = peewee.TextField(null=True)
 
+    class Meta:
+        indexes = (
+            # serves a user's activity newest first, ties broken by rowid
+            (('user', 'timestamp'), False),
+            # a user's submissions to a recipient, newest first
+            (('recipient', 'user', 'timestamp'), False),
+        )
+
+    @classmethod
+    def sent_to(cls, recipient, user):
+        return (cls.select()
+                .where((cls.recipient == recipient) & (cls.user == user))
+                .order_by(cls.timestamp.desc()))
+
+    # The users of usr_tbl, the User model of orbit.db attached alongside,
+    # who have sent nothing to recipient
+    @classmethod
+    def users_without(cls, usr_tbl, recipient):
+        sent = (cls.select()
+                .where((cls.user == usr_tbl.username) &
+                       (cls.recipient == recipient)))
+        return (usr_tbl.select(usr_tbl.username)
+                .where(~peewee.fn.EXISTS(sent))
+                .order_by(usr_tbl.id))
+
 
 class Gradeable(BaseModel):
     submission_id = peewee.TextField(unique=True)
@@ -29,6 +58,50 @@ class Gradeable(BaseModel):
     component = peewee.TextField()
     auto_feedback = peewee.TextField(null=True)
 
+    class Meta:
+        # the latest gradeable of a user for a component of an assignment
+        indexes = ((('user', 'assignment', 'component', 'timestamp'), False),)
+
+    # Every user of usr_tbl, the User model of orbit.db attached alongside,
+    # with their latest gradeable for a component, all of whose columns
+    # are null for those who have none
+    @classmethod
+    def latest_of_each_user(cls, usr_tbl, assignment, component):
+        newer = cls.alias()
+        is_latest = ~peewee.fn.EXISTS(
+            newer.select().where((newer.user == cls.user) &
+                                 (newer.assignment == assignment) &
+                                 (newer.component == component) &
+                                 (newer.timestamp > cls.timestamp)))
+        return (usr_tbl.select(usr_tbl.username, cls)
+                .join(cls, peewee.JOIN.LEFT_OUTER,
+                      on=((cls.user == usr_tbl.username) &
+                          (cls.assignment == assignment) &
+                          (cls.component == component) & is_latest))
+                .order_by(usr_tbl.id)
+                .objects(cls))
+
+
+# Schema changes made since the first deployment, see sqlitedb.migrate
+# create_tables() only adds tables and indexes that do not exist yet
+MIGRATIONS = [
+    # Submission by (user, timestamp) and (recipient, user, timestamp),
+    # Gradeable by (user, assignment, component, timestamp)
+    lambda: DB.create_tables([Submission, Gradeable]),
+]
+
+
+def migrate():
+    return sqlitedb.migrate(DB, BaseModel.__subclasses__(), MIGRATIONS)
+
 
 if __name__ == '__main__':
-    DB.create_tables(BaseModel.__subclasses__())
+    parser = argparse.ArgumentParser(description='Migrate submissions.db')
+    parser.add_argument('--hold', action='store_true',
+                        help='Then keep it open until killed, see sqlitedb.hold')
+    args = parser.parse_args()
+    print('submissions.db schema version {} -> {}'.format(*migrate()),
+          flush=True)
+    if args.hold:
+        sqlitedb.hold(DB)
+        signal.pause()
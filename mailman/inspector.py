@@ -4,7 +4,11 @@ from datetime import datetime
 from argparse import ArgumentParser as ap
 
 import db
+import denis.db
 import orbit.db
+import sqlitedb
+
+cross = sqlitedb.Attached(orbit.db, mailman=db, denis=denis.db)
 
 
 def main():
@@ -82,11 +86,8 @@ def gradables(assignment, username, component):
 
 
 def missing(assignment):
-    query = db.Submission.select().where(db.Submission.recipient == assignment)
-    submitted = {sub.user for sub in query}
-    for user in orbit.db.User.select():
-        if user.username not in submitted:
-            print(user.username)
+    for user in cross.Submission.users_without(cross.User, assignment):
+        print(user.username)
 
 
 def oopsie(assignment, username):
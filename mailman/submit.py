@@ -6,7 +6,9 @@ import sys
 
 import db
 import denis.db
+import orbit.db
 import patchset
+import sqlitedb
 
 
 Email = collections.namedtuple('Email', ['rcpt', 'msg_id'])
@@ -17,6 +19,38 @@ def email_from_log_line(line):
     return Email(rcpt=recipient, msg_id=message_id)
 
 
+# A gradeable and the dashboard row showing it are written in one
+# transaction, so that neither is ever recorded without the other
+def record_gradeable(asn, user, component, submission_id, timestamp,
+                     auto_feedback):
+    gradeable = {'submission_id': submission_id, 'timestamp': timestamp,
+                 'user': user, 'assignment': asn.name,
+                 'component': component, 'auto_feedback': auto_feedback}
+    both = sqlitedb.Attached(db, writable=True, orbit=orbit.db)
+    try:
+        with both.database.atomic('IMMEDIATE'):
+            both.Gradeable.create(**gradeable)
+            both.DashboardRow.record_gradeable(user, asn.name,
+                                               asn.initial_due_date,
+                                               asn.final_due_date, component,
+                                               submission_id, timestamp,
+                                               auto_feedback)
+        return
+    except db.peewee.OperationalError as ex:
+        # orbit.db is locked for too long or not migrated yet, the
+        # submission still counts and the dashboard is made over from
+        # every gradeable, which creates its table if need be
+        print(f'dashboard not updated ({ex}), rebuilding it', file=sys.stderr)
+    finally:
+        both.database.close()
+    db.Gradeable.create(**gradeable)
+    cross = sqlitedb.Attached(orbit.db, mailman=db, denis=denis.db)
+    try:
+        orbit.db.DashboardRow.rebuild(cross)
+    finally:
+        cross.database.close()
+
+
 # We assume inputs are correct as a precondition
 # Otherwise we simply crash
 def main(argv):
@@ -77,8 +111,7 @@ def main(argv):
                else 'final' if timestamp < asn.final_due_date else None)
         if not typ:
             return set_status(f'{asn.name} past due')
-        gr_db.create(submission_id=logfile, timestamp=timestamp, user=user,
-                     assignment=asn.name, component=typ, auto_feedback=auto_feedback)
+        record_gradeable(asn, user, typ, logfile, timestamp, auto_feedback)
         return set_status(f'{asn.name}: {typ}')
 
     if reply_id:
@@ -91,9 +124,7 @@ def main(argv):
             raise RuntimeError('invalid assignment name in gradeable DB')
         if timestamp > asn.peer_review_due_date:
             return set_status(f'{asn.name} review past due')
-        rev_db = denis.db.PeerReviewAssignment
-        rev = rev_db.get_or_none((rev_db.assignment == asn_name) &
-                                 (rev_db.reviewer == user))
+        rev = denis.db.PeerReviewAssignment.of(asn_name, user).first()
         if not rev:
             return set_status('ineligible for peer review')
         match emails[0].rcpt:
@@ -103,9 +134,7 @@ def main(argv):
                 typ = 'review2'
             case _:
                 return set_status('reviewed wrong submission')
-        gr_db.create(submission_id=logfile, timestamp=timestamp,
-                     user=user, assignment=asn_name, component=typ,
-                     auto_feedback=auto_feedback)
+        record_gradeable(asn, user, typ, logfile, timestamp, auto_feedback)
         return set_status(f'{asn_name}: {typ}')
 
     return set_status('Not a recognized recipient')
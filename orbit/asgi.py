@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+# radius as an ASGI application, for an ASGI server such as uvicorn:
+#
+#   uvicorn --host 0.0.0.0 --port 9098 asgi:application
+#
+# Every route is the same as under uWSGI. The ones that spend their time
+# waiting on a program, cgit and git fetches and clones over smart HTTP,
+# run it as an asyncio subprocess and stream its output from the event
+# loop, so any number of slow clients only cost a file descriptor or two
+# each. Everything else, sqlite and bcrypt included, is the WSGI
+# application run on a pool of threads. Unlike radius.ini this runs none
+# of bcryptd, fcgiwrap or the session reaper, which still have to be
+# started alongside it.
+
+import asyncio
+import concurrent.futures
+import io
+import sys
+import threading
+from http import HTTPStatus
+
+# internal imports
+import cgit
+import compress
+import config
+import githttp
+import radius
+
+_pool = concurrent.futures.ThreadPoolExecutor(config.asgi_threads,
+                                              thread_name_prefix='radius')
+
+
+async def _in_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+
+
+class _Request:
+    """
+    _Request: The body of an ASGI request as it arrives, and after that
+              whether the client has gone away, read from the one receive
+              callable which nothing else may call
+
+    ...
+
+    Methods
+    -------
+
+    read() : bytes
+        Wait for the whole body
+
+    disconnected()
+        Return once the body has been read and the client has left
+
+    """
+
+    def __init__(self, receive):
+        self._receive = receive
+        self._done = asyncio.Event()
+        self._gone = False
+
+    async def __aiter__(self):
+        try:
+            while not self._done.is_set():
+                message = await self._receive()
+                if message['type'] == 'http.disconnect':
+                    self._gone = True
+                    return
+                if (chunk := message.get('body', b'')):
+                    yield chunk
+                if not message.get('more_body'):
+                    return
+        finally:
+            self._done.set()
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self])
+
+    async def disconnected(self):
+        await self._done.wait()
+        while not self._gone:
+            self._gone = (await self._receive())['type'] == 'http.disconnect'
+
+
+def _environ(scope):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    env = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # PATH_INFO is the decoded path as latin-1, as under uWSGI
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        env[name] = f'{env[name]},{value}' if name in env else value
+    return env
+
+
+async def _git_http(rocket, request):
+    try:
+        username = await _in_pool(radius.git_http_user, rocket)
+    except radius.BUSY as ex:
+        return radius.busy_respond(rocket, ex)
+    if not username:
+        return rocket.raw_respond(HTTPStatus.UNAUTHORIZED)
+    path_info = rocket.path_info.removeprefix('/cgit')
+    try:
+        output = await githttp.run_async(rocket.env, path_info, username,
+                                         request)
+    except (OSError, EOFError, UnicodeDecodeError, ValueError) as ex:
+        print(f'git http-backend: Error {ex!r} at path_info "{path_info}"',
+              file=sys.stderr)
+        return rocket.raw_respond(HTTPStatus.INTERNAL_SERVER_ERROR)
+    return radius.git_http_respond(rocket, output)
+
+
+async def _cgit(rocket):
+    try:
+        refusal = await _in_pool(radius.cgit_refusal, rocket)
+    except radius.BUSY as ex:
+        return radius.busy_respond(rocket, ex)
+    if refusal:
+        return rocket.raw_respond(refusal)
+    cgit_env = radius.mk_cgit_env(rocket)
+    try:
+        path, output = await _in_pool(cgit.lookup, cgit_env,
+                                      compress.accepts_gzip(rocket.env))
+        output = output or await cgit.run_async(cgit_env, path)
+    except (OSError, EOFError, UnicodeDecodeError, ValueError) as ex:
+        return radius.cgit_internal_server_error(rocket, cgit_env, type(ex))
+    return radius.cgit_respond(rocket, cgit_env, output)
+
+
+class _Iterated:
+    # the body of a WSGI response, iterated and closed on the pool where it
+    # may still be querying sqlite or reading files, one step at a time as
+    # the thread of a step that was cancelled may not have finished it
+    # written is what the application passed to the write callable, which
+    # goes out before whatever it yields next
+
+    def __init__(self, body, written):
+        self._body = body
+        self._written = written
+        self._iterator = None
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            if self._iterator is None:
+                self._iterator = iter(self._body)
+            chunk = next(self._iterator, None)
+            if self._written:
+                chunk = b''.join([*self._written, chunk or b''])
+                self._written.clear()
+            return chunk
+
+    def _close(self):
+        with self._lock:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+
+    async def __aiter__(self):
+        while (chunk := await _in_pool(self._next)) is not None:
+            yield chunk
+
+    async def aclose(self):
+        await _in_pool(self._close)
+
+
+async def _stream(send, response, body):
+    started = False
+    async for chunk in body:
+        if not chunk:
+            continue
+        if not started:
+            await send(response())
+            started = True
+        await send({'type': 'http.response.body', 'body': chunk,
+                    'more_body': True})
+    if not started:
+        await send(response())
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _http(scope, receive, send):
+    request = _Request(receive)
+    env = _environ(scope)
+    status_headers = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        status_headers[:] = [status, headers]
+        return written.append
+
+    def response():
+        # the WSGI application may only decide on its status once it has
+        # produced the first chunk of the body
+        status, headers = status_headers
+        return {'type': 'http.response.start',
+                'status': int(status.split(' ')[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]}
+
+    rocket = radius.Rocket(env, start_response)
+    if rocket.method in ('GET', 'POST') and radius.is_git_http(rocket):
+        body = await _git_http(rocket, request)
+    else:
+        # a disconnect can only be seen once the body has been read
+        env['wsgi.input'] = io.BytesIO(await request.read())
+        if rocket.method == 'GET' and rocket.path_info.startswith('/cgit'):
+            body = await _cgit(rocket)
+        else:
+            body = await _in_pool(radius.application, env, start_response)
+
+    if not hasattr(body, '__aiter__'):
+        body = _Iterated(body, written)
+    stream = asyncio.ensure_future(_stream(send, response, body))
+    gone = asyncio.ensure_future(request.disconnected())
+    try:
+        await asyncio.wait([stream, gone],
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # a client that left stops whatever was still producing its
+        # response, a cgit or git process is killed
+        stream.cancel()
+        gone.cancel()
+        if isinstance(body, _Iterated):
+            await body.aclose()
+        else:
+            body.close()
+    if stream.done() and not stream.cancelled():
+        stream.result()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _pool.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError(f'unsupported ASGI scope type {scope["type"]}')
+    return await _http(scope, receive, send)
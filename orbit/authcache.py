@@ -1,25 +1,48 @@
+import contextlib
 import ctypes
+import os
 import sys
+import threading
+import time
+
+import cache
 
 _libmemcached = ctypes.CDLL('libmemcached.so')
+_libc = ctypes.CDLL(None)
 
 
 class _impl:
 
-    EXPIRATION_TIME = 2
-
-    MEMCACHED_NOTFOUND = 16
     MEMCACHED_SUCCESS = 0
+    MEMCACHED_NOTFOUND = 16
+    MEMCACHED_END = 21
+    MEMCACHED_MAX_KEY = 251
     server_config = b'--SOCKET="/run/orbit/memcached.sock" --BINARY-PROTOCOL'
 
+    # handles kept open for reuse by each process
+    POOL_SIZE = 4
+    # how long to serve from the local fallback after memcached fails
+    RETRY_SECONDS = 5
+    # bounds on the local fallback used while memcached is unavailable
+    FALLBACK_ENTRIES = 4096
+    FALLBACK_SECONDS = 300
+
     open = _libmemcached.memcached
+    close = _libmemcached.memcached_free
     set = _libmemcached.memcached_set
-    exist = _libmemcached.memcached_exist
+    get = _libmemcached.memcached_get
+    touch = _libmemcached.memcached_touch
+    mget = _libmemcached.memcached_mget
+    fetch = _libmemcached.memcached_fetch
+    free = _libc.free
 
 
 _impl.open.restype = ctypes.c_void_p
 _impl.open.argtypes = (ctypes.c_char_p, ctypes.c_size_t)
 
+_impl.close.restype = None
+_impl.close.argtypes = (ctypes.c_void_p,)
+
 _impl.set.restype = ctypes.c_int
 _impl.set.argtypes = (ctypes.c_void_p,
                       ctypes.c_char_p,
@@ -29,28 +52,194 @@ _impl.set.argtypes = (ctypes.c_void_p,
                       ctypes.c_time_t,
                       ctypes.c_uint32)
 
-_impl.exist.restype = ctypes.c_int
-_impl.exist.argtypes = (ctypes.c_void_p,
-                        ctypes.c_char_p,
-                        ctypes.c_size_t)
-
-_connection = _impl.open(_impl.server_config, len(_impl.server_config))
-
-
-def add_entry(key):
-    ret = _impl.set(_connection, key, len(key), None, 0,
-                    _impl.EXPIRATION_TIME, 0)
-
-    if ret != _impl.MEMCACHED_SUCCESS:
-        print(f'Failed to set cache {ret}', file=sys.stderr)
-
-    return ret == _impl.MEMCACHED_SUCCESS
-
+_impl.get.restype = ctypes.c_void_p
+_impl.get.argtypes = (ctypes.c_void_p,
+                      ctypes.c_char_p,
+                      ctypes.c_size_t,
+                      ctypes.POINTER(ctypes.c_size_t),
+                      ctypes.POINTER(ctypes.c_uint32),
+                      ctypes.POINTER(ctypes.c_int))
 
-def entry_exists(key):
-    ret = _impl.exist(_connection, key, len(key))
+_impl.touch.restype = ctypes.c_int
+_impl.touch.argtypes = (ctypes.c_void_p,
+                        ctypes.c_char_p,
+                        ctypes.c_size_t,
+                        ctypes.c_time_t)
 
-    if ret not in (_impl.MEMCACHED_SUCCESS, _impl.MEMCACHED_NOTFOUND):
-        print(f'Failed to retrieve cache item {ret}', file=sys.stderr)
+_impl.mget.restype = ctypes.c_int
+_impl.mget.argtypes = (ctypes.c_void_p,
+                       ctypes.POINTER(ctypes.c_char_p),
+                       ctypes.POINTER(ctypes.c_size_t),
+                       ctypes.c_size_t)
 
-    return ret == _impl.MEMCACHED_SUCCESS
+_impl.fetch.restype = ctypes.c_void_p
+_impl.fetch.argtypes = (ctypes.c_void_p,
+                        ctypes.c_char_p,
+                        ctypes.POINTER(ctypes.c_size_t),
+                        ctypes.POINTER(ctypes.c_size_t),
+                        ctypes.POINTER(ctypes.c_uint32),
+                        ctypes.POINTER(ctypes.c_int))
+
+_impl.free.restype = None
+_impl.free.argtypes = (ctypes.c_void_p,)
+
+
+class _Unavailable(Exception):
+    pass
+
+
+class _state:
+    lock = threading.Lock()
+    # handles are opened lazily and never shared across a fork
+    pid = None
+    pool = []
+    down_until = 0
+    fallback = cache.TTLCache(_impl.FALLBACK_ENTRIES, _impl.FALLBACK_SECONDS)
+    counters = {'hits': 0, 'misses': 0, 'errors': 0, 'fallback': 0}
+
+
+def _count(counter, n=1):
+    with _state.lock:
+        _state.counters[counter] += n
+
+
+# lookups made by this process, each uWSGI worker counts its own
+def stats():
+    with _state.lock:
+        return dict(_state.counters)
+
+
+@contextlib.contextmanager
+def _connection():
+    with _state.lock:
+        if _state.pid != os.getpid():
+            # the parent's handles share its sockets, so just forget them
+            _state.pid = os.getpid()
+            _state.pool = []
+        if time.time() < _state.down_until:
+            raise _Unavailable
+        handle = _state.pool.pop() if _state.pool else None
+    if handle is None:
+        handle = _impl.open(_impl.server_config, len(_impl.server_config))
+        if not handle:
+            _failed('open', None)
+    try:
+        yield handle
+    except _Unavailable:
+        # the handle may be mid request, open a fresh one next time
+        _impl.close(handle)
+        raise
+    with _state.lock:
+        if len(_state.pool) < _impl.POOL_SIZE:
+            _state.pool.append(handle)
+            handle = None
+    if handle is not None:
+        _impl.close(handle)
+
+
+def _failed(what, ret):
+    print(f'memcached {what} failed ({ret}), using local fallback',
+          file=sys.stderr)
+    with _state.lock:
+        _state.counters['errors'] += 1
+        _state.down_until = time.time() + _impl.RETRY_SECONDS
+    raise _Unavailable
+
+
+def _check(what, ret, ok=(_impl.MEMCACHED_SUCCESS,)):
+    if ret not in ok:
+        _failed(what, ret)
+    return ret
+
+
+def add_entry(key, value=b'', expiration=2):
+    try:
+        with _connection() as conn:
+            _check('set', _impl.set(conn, key, len(key), value, len(value),
+                                    expiration, 0))
+        return True
+    except _Unavailable:
+        _state.fallback.put(key, value, time.time() + expiration)
+        return False
+
+
+def _fallback_get(key):
+    if (value := _state.fallback.get(key)) is not None:
+        _count('fallback')
+    else:
+        _count('misses')
+    return value
+
+
+def get_entry(key):
+    value_len = ctypes.c_size_t()
+    flags = ctypes.c_uint32()
+    ret = ctypes.c_int()
+    try:
+        with _connection() as conn:
+            value = _impl.get(conn, key, len(key), ctypes.byref(value_len),
+                              ctypes.byref(flags), ctypes.byref(ret))
+            try:
+                _check('get', ret.value, (_impl.MEMCACHED_SUCCESS,
+                                          _impl.MEMCACHED_NOTFOUND))
+                if ret.value == _impl.MEMCACHED_NOTFOUND:
+                    _count('misses')
+                    return None
+                _count('hits')
+                return ctypes.string_at(value, value_len.value) if value else b''
+            finally:
+                if value:
+                    _impl.free(value)
+    except _Unavailable:
+        return _fallback_get(key)
+
+
+# fetch many keys in one round trip, returning the values of those found
+def get_entries(keys):
+    keys = list(keys)
+    if not keys:
+        return {}
+    key_array = (ctypes.c_char_p * len(keys))(*keys)
+    len_array = (ctypes.c_size_t * len(keys))(*map(len, keys))
+    key_buf = ctypes.create_string_buffer(_impl.MEMCACHED_MAX_KEY)
+    key_len = ctypes.c_size_t()
+    value_len = ctypes.c_size_t()
+    flags = ctypes.c_uint32()
+    ret = ctypes.c_int()
+    found = {}
+    try:
+        with _connection() as conn:
+            _check('mget', _impl.mget(conn, key_array, len_array, len(keys)))
+            while True:
+                value = _impl.fetch(conn, key_buf, ctypes.byref(key_len),
+                                    ctypes.byref(value_len),
+                                    ctypes.byref(flags), ctypes.byref(ret))
+                try:
+                    if ret.value in (_impl.MEMCACHED_END,
+                                     _impl.MEMCACHED_NOTFOUND):
+                        break
+                    _check('fetch', ret.value)
+                    key = key_buf.raw[:key_len.value]
+                    found[key] = (ctypes.string_at(value, value_len.value)
+                                  if value else b'')
+                finally:
+                    if value:
+                        _impl.free(value)
+    except _Unavailable:
+        values = {key: _fallback_get(key) for key in keys}
+        return {key: value for key, value in values.items()
+                if value is not None}
+    _count('hits', len(found))
+    _count('misses', len(keys) - len(found))
+    return found
+
+
+# slide the expiry of an entry forward so that it stays cached while in use
+def touch_entry(key, expiration):
+    try:
+        with _connection() as conn:
+            _check('touch', _impl.touch(conn, key, len(key), expiration),
+                   (_impl.MEMCACHED_SUCCESS, _impl.MEMCACHED_NOTFOUND))
+    except _Unavailable:
+        if (value := _state.fallback.get(key)) is not None:
+            _state.fallback.put(key, value, time.time() + expiration)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# password hashing service shared by all of the radius workers
+#
+# bcrypt deliberately takes a long time, so rather than let every worker
+# run it inline, the uWSGI master attaches this daemon which runs it in a
+# small process pool. Once the pool and its bounded queue are full any new
+# request is refused immediately so that radius can answer 503 right away
+# instead of leaving workers stuck behind a burst of logins.
+
+import bcrypt
+import concurrent.futures
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import config
+
+
+class Saturated(Exception):
+    pass
+
+
+def _run(deadline, op, args):
+    # the caller has already given up on requests that waited too long
+    if time.time() > deadline:
+        return None, True
+    match op:
+        case 'checkpw':
+            # a stored hash bcrypt cannot parse matches no password, this
+            # is not a reason to tell the user the server is busy
+            try:
+                return bcrypt.checkpw(args['password'].encode(),
+                                      args['pwdhash'].encode()), False
+            except ValueError:
+                return False, False
+        case 'hashpw':
+            return bcrypt.hashpw(args['password'].encode(),
+                                 bcrypt.gensalt()).decode(), False
+
+
+def _inline(op, args):
+    result, _ = _run(float('inf'), op, args)
+    return result
+
+
+def _call(op, **args):
+    deadline = time.time() + config.bcrypt_deadline_seconds
+    request = json.dumps({'op': op, 'args': args, 'deadline': deadline})
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(config.bcrypt_deadline_seconds)
+            sock.connect(config.bcrypt_socket)
+            sock.sendall(request.encode() + b'\n')
+            reply = json.loads(sock.makefile('rb').readline())
+    except (FileNotFoundError, ConnectionRefusedError) as ex:
+        print(f'bcryptd unavailable ({ex}), hashing inline', file=sys.stderr)
+        return _inline(op, args)
+    except (TimeoutError, OSError, ValueError) as ex:
+        print(f'bcryptd request failed: {ex!r}', file=sys.stderr)
+        raise Saturated
+    if reply.get('busy') or reply.get('expired'):
+        raise Saturated
+    return reply['result']
+
+
+def checkpw(password, pwdhash):
+    return _call('checkpw', password=password, pwdhash=pwdhash)
+
+
+def hashpw(password):
+    return _call('hashpw', password=password)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        if not self.server.slots.acquire(blocking=False):
+            reply = {'busy': True}
+        else:
+            try:
+                future = self.server.pool.submit(_run, request['deadline'],
+                                                 request['op'],
+                                                 request['args'])
+                result, expired = future.result()
+                reply = {'result': result, 'expired': expired}
+            finally:
+                self.server.slots.release()
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self):
+        try:
+            os.unlink(config.bcrypt_socket)
+        except FileNotFoundError:
+            pass
+        super().__init__(config.bcrypt_socket, Handler)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=config.bcrypt_workers)
+        self.slots = threading.BoundedSemaphore(config.bcrypt_workers +
+                                                config.bcrypt_queue)
+
+
+if __name__ == '__main__':
+    with Server() as server:
+        server.serve_forever()
@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    TTLCache: Bounded in-process cache with least recently used eviction
+              Every entry expires after at most ttl seconds, or earlier
+              if it is given an explicit expiry when it is stored
+              Safe to share between the threads of a worker
+
+    ...
+
+    Attributes
+    ----------
+
+    max_entries : int
+        Number of entries kept before the least recently used is evicted
+
+    ttl : float
+        Maximum lifetime of an entry in seconds
+
+    Methods
+    -------
+
+    get(key, default=None)
+        Get the live value stored under key or default
+
+    put(key, value, expiry=None)
+        Store value under key until the sooner of ttl or expiry (a unix time)
+
+    pop(key)
+        Remove any value stored under key
+
+    clear()
+        Remove every entry
+
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                return default
+            value, expiry = entry
+            if expiry <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expiry=None):
+        limit = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, limit if expiry is None
+                                  else min(expiry, limit))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
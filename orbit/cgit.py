@@ -0,0 +1,609 @@
+import asyncio
+import hashlib
+import io
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import compress
+import config
+
+CGIT = '/usr/share/webapps/cgit/cgit'
+
+# bytes of output handed to the server at a time
+CHUNK_SIZE = 64 * 1024
+# a header block longer than this is not something cgit would produce
+MAX_HEADER_BYTES = 64 * 1024
+
+
+def read_headers(stream):
+    headers = []
+    total = 0
+    while (line := stream.readline(MAX_HEADER_BYTES)) not in (b'\n', b'\r\n'):
+        total += len(line)
+        if not line.endswith(b'\n') or total > MAX_HEADER_BYTES:
+            raise ValueError('truncated or oversized CGI header block')
+        headers.append(_header(line))
+    return headers
+
+
+async def read_headers_async(stream):
+    headers = []
+    total = 0
+    # the stream is made with a limit of MAX_HEADER_BYTES, past which
+    # readline raises ValueError
+    while (line := await stream.readline()) not in (b'\n', b'\r\n'):
+        total += len(line)
+        if not line.endswith(b'\n') or total > MAX_HEADER_BYTES:
+            raise ValueError('truncated or oversized CGI header block')
+        headers.append(_header(line))
+    return headers
+
+
+def _header(line):
+    name, value = line.decode().rstrip('\r\n').split(': ', maxsplit=1)
+    return name, value
+
+
+class Output:
+    """
+    Output: Response of a running CGI program, read as it is produced
+            Only the header block is read up front, the body is then
+            streamed in chunks when the object is iterated, optionally
+            between a prefix and a suffix, so a large response is never
+            held in memory. Closing it stops the program if it is still
+            running, which the WSGI server does even if the client leaves
+
+    ...
+
+    Attributes
+    ----------
+
+    headers : list
+        The (name, value) pairs of the CGI header block in order
+
+    Methods
+    -------
+
+    wrap(prefix, suffix)
+        Send prefix before the body and suffix after it, this may switch
+        the output over to a compressed copy which changes the headers
+
+    tee(entry)
+        Also store the output in a cache entry as it is streamed, which is
+        only kept if succeeded() says the program finished without error
+
+    close()
+        Stop the program and release its output
+
+    """
+
+    def __init__(self, stream, stop, succeeded, compressed=None):
+        self._stream = stream
+        self._stop = stop
+        self._succeeded = succeeded
+        self._prefix = b''
+        self._suffix = b''
+        self._entry = None
+        self._compressed = compressed
+        self._gzip = None
+        try:
+            self.headers = read_headers(stream)
+        except (OSError, EOFError, UnicodeDecodeError, ValueError):
+            self.close()
+            raise
+        self._use_compressed(b'')
+
+    def _use_compressed(self, prefix):
+        # a compressed copy of cached output, usable if it was made with
+        # the same prefix, in which case it replaces the plain output
+        if not self._compressed or self._gzip:
+            return
+        header = self._compressed.read(2 * _stamp.size)
+        if compress.prefix_stamp(header[_stamp.size:]) != (
+                zlib.crc32(prefix), len(prefix)):
+            self._compressed.seek(0)
+            return
+        self._gzip = compress.prefix_stamp(header)
+        self._stream.close()
+        self._stream = self._compressed
+        self.headers = compress.gzipped_headers(self.headers)
+
+    def wrap(self, prefix, suffix):
+        self._prefix = prefix
+        self._suffix = suffix
+        if self._entry:
+            self._entry.prefix(prefix)
+        self._use_compressed(prefix)
+
+    def tee(self, entry):
+        self._entry = entry
+
+    def __iter__(self):
+        if self._gzip:
+            yield compress.gzip_header()
+            while (chunk := self._stream.read1(CHUNK_SIZE)):
+                yield chunk
+            yield compress.gzip_finish(self._suffix, *self._gzip)
+            return
+        if self._prefix:
+            yield self._prefix
+        while (chunk := self._stream.read1(CHUNK_SIZE)):
+            if self._entry:
+                self._entry.write(chunk)
+            yield chunk
+        if self._entry:
+            # output cut short by cgit dying is not a page worth keeping
+            if self._succeeded():
+                self._entry.commit()
+            else:
+                self._entry.discard()
+        if self._suffix:
+            yield self._suffix
+
+    def close(self):
+        # an entry not committed by now holds only part of the output
+        if self._entry:
+            self._entry.discard()
+        if self._compressed:
+            self._compressed.close()
+        self._stop()
+        self._stream.close()
+
+
+class AsyncOutput(Output):
+    """
+    AsyncOutput: Output of a CGI program run by asyncio, for the ASGI
+                 application, iterated with async for rather than for so
+                 that waiting on the program never holds up a thread
+                 Output that is already on disk is never this, the cache
+                 is always read through Output
+
+    ...
+
+    Methods
+    -------
+
+    start(proc, feeder=None) : AsyncOutput
+        Read the header block of the process and give its output, feeder
+        is a task writing its standard input that is cancelled on close
+
+    """
+
+    __iter__ = None
+
+    def __init__(self, proc, feeder):
+        self._proc = proc
+        self._feeder = feeder
+        self._stream = proc.stdout
+        self._prefix = b''
+        self._suffix = b''
+        self._entry = None
+        self._compressed = None
+        self._gzip = None
+        self.headers = []
+
+    @classmethod
+    async def start(cls, proc, feeder=None):
+        output = cls(proc, feeder)
+        try:
+            output.headers = await read_headers_async(proc.stdout)
+        except BaseException:
+            # which includes the request being cancelled
+            output.close()
+            raise
+        return output
+
+    async def __aiter__(self):
+        if self._prefix:
+            yield self._prefix
+        while (chunk := await self._stream.read(CHUNK_SIZE)):
+            if self._entry:
+                self._entry.write(chunk)
+            yield chunk
+        if self._entry:
+            # output cut short by cgit dying is not a page worth keeping
+            if await self._proc.wait() == 0:
+                # which may sweep the whole cache
+                await asyncio.to_thread(self._entry.commit)
+            else:
+                self._entry.discard()
+        if self._suffix:
+            yield self._suffix
+
+    def close(self):
+        if self._entry:
+            self._entry.discard()
+        if self._feeder:
+            self._feeder.cancel()
+        # the event loop reaps the process once it has exited, which
+        # proc.kill() could do behind its back by polling it first
+        if self._proc.returncode is None:
+            try:
+                os.kill(self._proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def _popen(env):
+    proc = subprocess.Popen([CGIT],
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            env=env)
+
+    def stop():
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+    return Output(proc.stdout, stop, lambda: proc.wait() == 0)
+
+
+# A minimal FastCGI responder client, just enough to talk to fcgiwrap
+#
+# fcgiwrap keeps a pool of small, already running workers that each fork
+# and exec the CGI program, so radius never has to fork its own far larger
+# process for every page. One request is sent per connection.
+
+_FCGI_VERSION = 1
+_FCGI_BEGIN_REQUEST = 1
+_FCGI_END_REQUEST = 3
+_FCGI_PARAMS = 4
+_FCGI_STDIN = 5
+_FCGI_STDOUT = 6
+_FCGI_RESPONDER = 1
+_FCGI_REQUEST_ID = 1
+_FCGI_MAX_CONTENT = 0xffff
+_FCGI_REQUEST_COMPLETE = 0
+
+_record = struct.Struct('>BBHHBx')
+# appStatus, the exit status of the program, and protocolStatus
+_end_request = struct.Struct('>IB3x')
+
+
+def _fcgi_record(kind, content=b''):
+    return _record.pack(_FCGI_VERSION, kind, _FCGI_REQUEST_ID,
+                        len(content), 0) + content
+
+
+def _fcgi_length(n):
+    return bytes([n]) if n < 0x80 else struct.pack('>I', n | 0x80000000)
+
+
+def _fcgi_params(env):
+    pairs = b''.join(_fcgi_length(len(name)) + _fcgi_length(len(value)) +
+                     name + value for name, value in
+                     ((name.encode(), value.encode())
+                      for name, value in env.items()))
+    return b''.join(_fcgi_record(_FCGI_PARAMS,
+                                 pairs[i:i + _FCGI_MAX_CONTENT])
+                    for i in range(0, len(pairs), _FCGI_MAX_CONTENT))
+
+
+class _FastCGIStdout(io.RawIOBase):
+    # the stdout stream of a request, stderr and everything else is dropped
+    # completed is whether the program exited 0 once the stream has ended
+
+    def __init__(self, sock):
+        self._file = sock.makefile('rb')
+        self._pending = b''
+        self._done = False
+        self.completed = False
+
+    def readable(self):
+        return True
+
+    def _read_exactly(self, n):
+        data = self._file.read(n)
+        if len(data) != n:
+            raise EOFError('fcgiwrap closed the connection mid record')
+        return data
+
+    def readinto(self, buffer):
+        while not self._pending and not self._done:
+            _, kind, _, length, padding = _record.unpack(
+                self._read_exactly(_record.size))
+            content = self._read_exactly(length + padding)[:length]
+            if kind == _FCGI_STDOUT:
+                self._pending = content
+            elif kind == _FCGI_END_REQUEST:
+                self._done = True
+                app_status, protocol_status = _end_request.unpack(content)
+                self.completed = (app_status == 0 and
+                                  protocol_status == _FCGI_REQUEST_COMPLETE)
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _fcgi(env):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(config.cgit_fcgi_timeout_seconds)
+        sock.connect(config.cgit_fcgi_socket)
+        sock.sendall(b''.join([
+            _fcgi_record(_FCGI_BEGIN_REQUEST,
+                         struct.pack('>HB5x', _FCGI_RESPONDER, 0)),
+            _fcgi_params({**env, 'SCRIPT_FILENAME': CGIT,
+                          'REQUEST_METHOD': 'GET'}),
+            _fcgi_record(_FCGI_PARAMS),
+            _fcgi_record(_FCGI_STDIN),
+        ]))
+        stdout = _FastCGIStdout(sock)
+        stream = io.BufferedReader(stdout, CHUNK_SIZE)
+    except BaseException:
+        sock.close()
+        raise
+    return Output(stream, sock.close, lambda: stdout.completed)
+
+
+# On disk cache of cgit output shared by every radius worker
+#
+# An entry is the verbatim output of cgit after a line holding the time it
+# was stored. Its key covers the request and a fingerprint of the refs of
+# the repository the page is about, so a push makes the pages rendered
+# before it unreachable and they age out with everything else once the
+# cache is over its size bound. The mtime of an entry is when it was last
+# used, which is what the least recently used entries are evicted by.
+#
+# Output of a compressible type also gets a compressed copy of whatever
+# prefix it was wrapped in followed by the body, for clients taking gzip.
+# The copy starts with the stamp of the whole and of the prefix alone, and
+# is only used when the output is wrapped in the same prefix again.
+
+_stamp = struct.Struct('<II')
+
+
+def _repo_dir(parts):
+    for i in range(len(parts), 0, -1):
+        candidate = os.path.join(config.cgit_scan_path, *parts[:i])
+        if os.path.isfile(os.path.join(candidate, 'HEAD')):
+            return candidate
+    return None
+
+
+def _repos():
+    for root, dirs, files in os.walk(config.cgit_scan_path):
+        if 'HEAD' in files:
+            # nothing inside a repository is another one
+            dirs[:] = []
+            yield root
+        else:
+            dirs.sort()
+
+
+def _fingerprint(repo):
+    def stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_ino, st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+    # pages not about one repository, such as the index, list all of them
+    # along with when each last changed, so a push to any of them counts
+    if repo is None:
+        return [stat(config.cgit_scan_path),
+                *[_fingerprint(path) for path in _repos()]]
+    # updating a loose ref renames a lockfile into place, so the
+    # directory holding it is touched even when the ref is rewritten
+    return [stat(os.path.join(repo, 'HEAD')),
+            stat(os.path.join(repo, 'packed-refs')),
+            *[(root, stat(root)) for root, _, _
+              in os.walk(os.path.join(repo, 'refs'))]]
+
+
+def _cache_path(env):
+    if not config.cgit_cache_max_bytes:
+        return None
+    path_info = env.get('PATH_INFO', '')
+    parts = [part for part in path_info.split('/') if part]
+    if '..' in parts:
+        return None
+    key = hashlib.sha256(repr([path_info, env.get('QUERY_STRING', ''),
+                               _fingerprint(_repo_dir(parts))])
+                         .encode()).hexdigest()
+    return os.path.join(config.cgit_cache_dir, key[:2], key)
+
+
+def _lookup(path, gzip):
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    compressed = None
+    try:
+        if float(file.readline()) + config.cgit_cache_seconds < time.time():
+            file.close()
+            return None
+        os.utime(path)
+        if gzip:
+            try:
+                compressed = open(f'{path}.gz', 'rb')
+                os.utime(f'{path}.gz')
+            except FileNotFoundError:
+                pass
+        return Output(file, lambda: None, lambda: True, compressed)
+    except (OSError, EOFError, UnicodeDecodeError, ValueError):
+        file.close()
+        if compressed:
+            compressed.close()
+        return None
+
+
+def _sweep():
+    # at most one worker looks over the whole cache every so often
+    marker = os.path.join(config.cgit_cache_dir, '.swept')
+    try:
+        if time.time() - os.stat(marker).st_mtime < config.cgit_cache_sweep_seconds:
+            return
+    except FileNotFoundError:
+        pass
+    with open(marker, 'w'):
+        os.utime(marker)
+    entries = []
+    for root, _, files in os.walk(config.cgit_cache_dir):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if file.startswith('.tmp-'):
+                # left behind by a worker that died mid response
+                if time.time() - st.st_mtime > config.cgit_fcgi_timeout_seconds * 10:
+                    entries.append((0, st.st_size, path))
+            elif not file.startswith('.'):
+                entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= config.cgit_cache_max_bytes and mtime:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class _Entry:
+    # a cache entry being written as the output it holds is streamed
+
+    def __init__(self, path, headers):
+        self._path = path
+        self._size = 0
+        self._files = {}
+        self._compressor = None
+        self._open(path)
+        self._files[path][1].write(
+            f'{time.time()}\n'.encode() +
+            b''.join(f'{name}: {value}\n'.encode()
+                     for name, value in headers) + b'\n')
+        if compress.compressible(dict(headers).get('Content-Type', '')):
+            self._compressor = compress.PrefixCompressor()
+            self._open(f'{path}.gz')
+            # room for the stamp of the whole, which is known at the end
+            self._files[f'{path}.gz'][1].write(bytes(_stamp.size))
+            self._prefixed = False
+
+    def _open(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        self._files[path] = (tmp, os.fdopen(fd, 'wb'))
+
+    def prefix(self, data):
+        if self._compressor and not self._prefixed:
+            self._write_compressed(_stamp.pack(zlib.crc32(data), len(data)))
+            self._prefixed = True
+            self._write_compressed(self._compressor.compress(data))
+
+    def _write_compressed(self, data):
+        try:
+            self._files[f'{self._path}.gz'][1].write(data)
+        except (KeyError, OSError):
+            self.discard()
+
+    def write(self, data):
+        if not self._files:
+            return
+        self._size += len(data)
+        if self._size > config.cgit_cache_entry_max_bytes:
+            return self.discard()
+        try:
+            self._files[self._path][1].write(data)
+        except OSError:
+            return self.discard()
+        if self._compressor:
+            self.prefix(b'')
+            self._write_compressed(self._compressor.compress(data))
+
+    def commit(self):
+        if not self._files:
+            return
+        try:
+            if self._compressor:
+                self.prefix(b'')
+                _, file = self._files[f'{self._path}.gz']
+                file.write(self._compressor.flush())
+                file.seek(0)
+                file.write(self._compressor.header())
+            # the compressed copy goes first, it is never used on its own
+            for path, (tmp, file) in sorted(self._files.items(),
+                                            reverse=True):
+                file.close()
+                os.replace(tmp, path)
+            self._files = {}
+            _sweep()
+        except OSError as ex:
+            print(f'cgit: could not cache output: {ex!r}', file=sys.stderr)
+            self.discard()
+
+    def discard(self):
+        for tmp, file in self._files.values():
+            file.close()
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        self._files = {}
+
+
+def _run(env):
+    if config.cgit_backend == 'fcgi':
+        try:
+            return _fcgi(env)
+        except (FileNotFoundError, ConnectionRefusedError) as ex:
+            print(f'fcgiwrap unavailable ({ex}), running cgit directly',
+                  file=sys.stderr)
+    return _popen(env)
+
+
+def _tee(output, path):
+    # only successful pages are worth keeping
+    if path and output.headers and output.headers[0][0] != 'Status':
+        try:
+            output.tee(_Entry(path, output.headers))
+        except OSError as ex:
+            print(f'cgit: could not cache output: {ex!r}', file=sys.stderr)
+    return output
+
+
+# Find the output of cgit for a request in the cache, with a compressed copy
+# used where it can be if gzip is true, returned along with the path it is
+# stored under once cgit has been run if it is not there yet
+def lookup(env, gzip=False):
+    path = _cache_path(env)
+    return path, (_lookup(path, gzip) if path else None)
+
+
+# Run cgit for a request or find its output in the cache
+def run(env, gzip=False):
+    path, output = lookup(env, gzip)
+    return output or _tee(_run(env), path)
+
+
+# Run cgit for a request as an asyncio subprocess, storing its output under
+# path from lookup() as it is read
+#
+# This never goes through fcgiwrap: the pool is there to spare a uWSGI
+# worker the cost of forking itself, where the ASGI application instead
+# spawns cgit from the event loop and never waits on it.
+async def run_async(env, path=None):
+    proc = await asyncio.create_subprocess_exec(
+        CGIT,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        env=env,
+        limit=MAX_HEADER_BYTES)
+    return _tee(await AsyncOutput.start(proc), path)
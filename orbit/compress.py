@@ -0,0 +1,252 @@
+import struct
+import zlib
+
+# gzip members are built by hand so that a compressed page prefix can be
+# stored once and then finished with a freshly compressed per-request tail
+#
+# The prefix is compressed with a full flush, which ends its last block on
+# a byte boundary without marking it final and leaves no back references
+# for later data to depend on. A new raw deflate stream for the tail can
+# then simply be appended, and the gzip trailer only needs the crc and
+# length of the whole, which zlib can continue from those of the prefix.
+
+_header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_trailer = struct.Struct('<II')
+
+
+def accepts_gzip(env):
+    for coding in env.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        q = params.strip().removeprefix('q=')
+        try:
+            return not q or float(q) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def compressible(content_type):
+    # other types of content are usually compressed already
+    mime = content_type.partition(';')[0].strip().lower()
+    return mime.startswith('text/') or mime in (
+        'application/javascript', 'application/json', 'application/xml',
+        'image/svg+xml')
+
+
+def _varies(headers):
+    return any(name.lower() == 'vary' and 'accept-encoding' in value.lower()
+               for name, value in headers)
+
+
+# The headers of a response once its body is gzipped
+# the compressed bytes differ, but the content they stand for does not, so
+# the validator can remain as a weak one
+def gzipped_headers(headers):
+    headers = [(name, f'W/{value}' if name.lower() == 'etag' and
+                not value.startswith('W/') else value)
+               for name, value in headers
+               if name.lower() != 'content-length']
+    headers.append(('Content-Encoding', 'gzip'))
+    if not _varies(headers):
+        headers.append(('Vary', 'Accept-Encoding'))
+    return headers
+
+
+def _raw(data, mode, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(mode)
+
+
+class PrefixCompressor:
+    """
+    PrefixCompressor: Incrementally build what deflate_prefix returns
+                      for data that arrives in pieces
+
+    ...
+
+    Methods
+    -------
+
+    compress(data) : bytes
+        Compress the next piece, returning any compressed output ready
+
+    flush() : bytes
+        Compress everything so far, returning the remaining output
+
+    header() : bytes
+        The header that goes in front of the compressed output once flushed,
+        prefix_stamp() reads the crc and length of the input back out of it
+
+    """
+
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            -zlib.MAX_WBITS)
+        self._crc = 0
+        self._length = 0
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._length += len(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_FULL_FLUSH)
+
+    def header(self):
+        return _trailer.pack(self._crc, self._length & 0xffffffff)
+
+
+# returns a compressed prefix that gzip_splice can later finish
+def deflate_prefix(data, level=9):
+    compressor = PrefixCompressor(level)
+    body = compressor.compress(data) + compressor.flush()
+    return compressor.header() + body
+
+
+# Streaming a prefix that is too big to hold in memory takes three steps:
+# send gzip_header(), then the compressed data following its header, and
+# last gzip_finish() with the tail and the crc and length from the header
+def gzip_header():
+    return _header
+
+
+def prefix_stamp(header):
+    return _trailer.unpack_from(header)
+
+
+def gzip_finish(tail, crc, length, level=6):
+    return _raw(tail, zlib.Z_FINISH, level) + _trailer.pack(
+        zlib.crc32(tail, crc), (length + len(tail)) & 0xffffffff)
+
+
+def gzip_splice(prefix, tail, level=6):
+    return b''.join([_header, prefix[_trailer.size:],
+                     gzip_finish(tail, *prefix_stamp(prefix), level)])
+
+
+class GzipMiddleware:
+    """
+    GzipMiddleware: WSGI middleware compressing responses for clients
+                    that accept gzip, when they are of a compressible type,
+                    at least min_bytes long and not already encoded
+                    The response is compressed as it streams, each chunk
+                    from the application is flushed on its own so that
+                    nothing is held back waiting for more output
+
+    ...
+
+    Attributes
+    ----------
+
+    app : callable
+        The WSGI application being wrapped
+
+    min_bytes : int
+        Responses shorter than this are sent as they are
+
+    level : int
+        zlib compression level
+
+    """
+
+    def __init__(self, app, min_bytes, level):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.level = level
+
+    def __call__(self, env, start_response):
+        response = _Response(env, start_response, self.min_bytes, self.level)
+        return response.respond(self.app(env, response.start_response))
+
+
+class _Response:
+    # One response passing through GzipMiddleware. The application may send
+    # its body with the write callable as well as return it, either way it
+    # goes through the same compressor in the order it was produced. The
+    # first write decides on compression right away, as write must not
+    # hold data back.
+
+    def __init__(self, env, start_response, min_bytes, level):
+        self._env = env
+        self._start_response = start_response
+        self._min_bytes = min_bytes
+        self._level = level
+        self._status = None
+        self._headers = None
+        self._pending = []
+        self._size = 0
+        self._started = False
+        self._write = None
+        self._compressor = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info and self._started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self._status = status
+        self._headers = headers
+        return self.write
+
+    def _eligible(self, status, headers):
+        names = {name.lower(): value for name, value in headers}
+        return (self._env.get('REQUEST_METHOD') != 'HEAD'
+                and status[:3] not in ('204', '206', '304')
+                and 'content-encoding' not in names
+                and compressible(names.get('content-type', '')))
+
+    # Send the headers, returning the pending chunks ready to follow them
+    def _start(self):
+        status, headers = self._status, self._headers
+        eligible = self._eligible(status, headers)
+        # a 304 stands for a response that may have been compressed
+        if (eligible or status[:3] == '304') and not _varies(headers):
+            headers.append(('Vary', 'Accept-Encoding'))
+        if (eligible and self._size >= self._min_bytes
+                and accepts_gzip(self._env)):
+            headers = gzipped_headers(headers)
+            self._compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        self._started = True
+        self._write = self._start_response(status, headers)
+        pending, self._pending = self._pending, []
+        return self._encode(b''.join(pending))
+
+    def _encode(self, data):
+        if not self._compressor:
+            return data
+        return (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def write(self, data):
+        if not self._started:
+            self._pending.append(data)
+            self._size += len(data)
+            data = self._start()
+        else:
+            data = self._encode(data)
+        if data:
+            self._write(data)
+
+    def respond(self, body):
+        try:
+            chunks = iter(body)
+            for chunk in chunks:
+                if self._started:
+                    # the application wrote while producing this chunk
+                    yield self._encode(chunk)
+                    break
+                self._pending.append(chunk)
+                self._size += len(chunk)
+                if self._size >= self._min_bytes:
+                    break
+            if not self._started:
+                yield self._start()
+            for chunk in chunks:
+                yield self._encode(chunk)
+            if self._compressor:
+                yield self._compressor.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
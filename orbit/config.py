@@ -4,8 +4,83 @@ version_info = '${orbit_version_info}'
 doc_root = './docs'
 doc_header = './header.html'
 
+# rendered documents each worker keeps, they are rerendered when they change
+md_cache_entries = 128
+
+# where prerender.py puts documents rendered ahead of time, radius serves
+# these when they are up to date and only renders a document itself if not
+prerender_root = '/var/cache/orbit/docs'
+
+# bare repository holding the grade and feedback notes
+grading_repo = '/var/lib/git/grading.git'
+
 # duration of authentication token validity period
 minutes_each_session_token_is_valid = 180
 
+# sessions each worker remembers without asking the database and for how
+# long, all of them are forgotten when another process or thread has written
+# to orbit.db, which the worker checks every revocation_check_seconds
+session_cache_entries = 1024
+session_cache_seconds = 30
+
+# 'table' keeps a row per session in orbit.db and looks it up on each request
+# 'signed' puts the username and expiry in an HMAC signed cookie instead and
+# only stores revoked sessions, which each worker rechecks at most this often
+session_mode = 'table'
+session_key_file = '/var/lib/orbit/session.key'
+revocation_check_seconds = 5
+
+# how long a successful or failed password check is remembered in seconds
+credential_cache_seconds = 300
+credential_failure_cache_seconds = 30
+
+# bcrypt runs in a pool of this many processes shared by all radius workers
+# with this many more requests allowed to wait, anything beyond gets a 503
+# as does any request that cannot be answered within the deadline
+bcrypt_socket = '/run/orbit/bcryptd.sock'
+bcrypt_workers = 2
+bcrypt_queue = 8
+bcrypt_deadline_seconds = 2
+
+# 'popen' runs cgit as a child of the radius worker for each page
+# 'fcgi' asks the fcgiwrap pool started in radius.ini to run it instead,
+# falling back to 'popen' if fcgiwrap is not there
+cgit_backend = 'fcgi'
+cgit_fcgi_socket = '/run/orbit/fcgiwrap.sock'
+cgit_fcgi_timeout_seconds = 30
+
+# cgit output is kept on disk until the refs of the repository move or it
+# is too old, the least recently used entries are dropped once there is
+# more than cgit_cache_max_bytes of it, or none at all is kept if that is 0
+# cgit_scan_path must match scan-path in cgitrc
+cgit_scan_path = '/var/lib/git/course_repos'
+cgit_cache_dir = '/var/cache/orbit/cgit'
+cgit_cache_max_bytes = 256 * 1024 * 1024
+cgit_cache_entry_max_bytes = 16 * 1024 * 1024
+cgit_cache_seconds = 300
+cgit_cache_sweep_seconds = 60
+
+# threads of the ASGI application (asgi.py) that run everything that is
+# not cgit or git, sqlite queries and password checks included, in each
+# process; cgit and git run on the event loop however many are in flight
+asgi_threads = 16
+
+# submissions listed on each page of the activity log
+activity_page_size = 50
+
+# responses at least this long are gzipped for clients that accept it
+compress_min_bytes = 1024
+compress_level = 6
+
+# token buckets limiting password checks that miss the credential cache
+# each allows a burst of attempts and then refills at rate per second
+# the user bucket is kept per user and client and only charged for failures
+ratelimit_file = '/run/orbit/ratelimit'
+ratelimit_slots = 4096
+ratelimit_user_burst = 10
+ratelimit_user_rate = 1 / 6
+ratelimit_source_burst = 30
+ratelimit_source_rate = 1 / 2
+
 # length in bytes of amount of random data used to generate passwords
 num_bytes_entropy_for_pw = 24
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import peewee
+import sys
 
-DB = peewee.SqliteDatabase('/var/lib/orbit/orbit.db')
+import sqlitedb
+
+DB = sqlitedb.Database('/var/lib/orbit/orbit.db')
 
 
 class BaseModel(peewee.Model):
@@ -21,14 +24,167 @@ class User(BaseModel):
 class Session(BaseModel):
     token = peewee.TextField(primary_key=True)
     username = peewee.TextField(unique=True)
-    expiry = peewee.FloatField()
+    expiry = peewee.FloatField(index=True)
+
+
+# Sessions that were ended early when config.session_mode is 'signed'
+# a null token revokes every session of username expiring by expiry
+class Revocation(BaseModel):
+    username = peewee.TextField()
+    token = peewee.TextField(null=True)
+    expiry = peewee.FloatField(index=True)
 
 
 class Oopsie(BaseModel):
     user = peewee.TextField(primary_key=True)
-    assignment = peewee.TextField()
+    assignment = peewee.TextField(index=True)
     timestamp = peewee.IntegerField()
 
+    @classmethod
+    def spent_on(cls, assignment):
+        return cls.select().where(cls.assignment == assignment)
+
+
+# Everything the dashboard shows a user about an assignment, so that it can
+# be served by one query. Kept up to date by whatever records the data it is
+# made from: mailman for gradeables, denis for assignments and peer reviews
+# and radius for oopsies. `hyperspace --rebuilddashboard` recreates it all
+class DashboardRow(BaseModel):
+    user = peewee.TextField()
+    assignment = peewee.TextField()
+    initial_due_date = peewee.IntegerField()
+    final_due_date = peewee.IntegerField()
+    # the assignment the user spent their oopsie on, wherever that was
+    oopsie = peewee.TextField(null=True)
+    peer1 = peewee.TextField(null=True)
+    peer2 = peewee.TextField(null=True)
+    # the latest gradeable of each component
+    initial_id = peewee.TextField(null=True)
+    initial_timestamp = peewee.IntegerField(null=True)
+    initial_feedback = peewee.TextField(null=True)
+    review1_id = peewee.TextField(null=True)
+    review1_timestamp = peewee.IntegerField(null=True)
+    review2_id = peewee.TextField(null=True)
+    review2_timestamp = peewee.IntegerField(null=True)
+    final_id = peewee.TextField(null=True)
+    final_timestamp = peewee.IntegerField(null=True)
+    final_feedback = peewee.TextField(null=True)
+
+    class Meta:
+        indexes = ((('user', 'assignment'), True),)
+
+    @classmethod
+    def upsert(cls, user, assignment, initial_due_date, final_due_date,
+               where=None, **fields):
+        update = {'initial_due_date': initial_due_date,
+                  'final_due_date': final_due_date, **fields}
+        # oopsie is named without a schema, so this finds it in orbit.db
+        # also when cls is bound to it through sqlitedb.Attached
+        oopsie = (Oopsie.select(Oopsie.assignment)
+                  .where(Oopsie.user == user))
+        return (cls.insert({'user': user, 'assignment': assignment,
+                            'oopsie': oopsie, **update})
+                .on_conflict(conflict_target=[cls.user, cls.assignment],
+                             update=update, where=where)
+                .execute())
+
+    @classmethod
+    def add_assignment(cls, assignment, initial_due_date, final_due_date):
+        for user in User.select(User.username):
+            cls.upsert(user.username, assignment, initial_due_date,
+                       final_due_date)
+
+    @classmethod
+    def set_due_dates(cls, assignment, initial_due_date, final_due_date):
+        return (cls.update({cls.initial_due_date: initial_due_date,
+                            cls.final_due_date: final_due_date})
+                .where(cls.assignment == assignment)
+                .execute())
+
+    @classmethod
+    def record_gradeable(cls, user, assignment, initial_due_date,
+                         final_due_date, component, submission_id, timestamp,
+                         auto_feedback):
+        fields = {f'{component}_id': submission_id,
+                  f'{component}_timestamp': timestamp}
+        if component in ('initial', 'final'):
+            fields[f'{component}_feedback'] = auto_feedback
+        # keep the latest even if gradeables are recorded out of order
+        latest = getattr(cls, f'{component}_timestamp')
+        return cls.upsert(user, assignment, initial_due_date, final_due_date,
+                          where=latest.is_null() | (latest <= timestamp),
+                          **fields)
+
+    # Regenerate every row from the databases the writers keep the table in
+    # step with, cross being a sqlitedb.Attached over all three of them
+    @classmethod
+    def rebuild(cls, cross):
+        usr_tbl = cross.User
+        asmt_tbl = cross.Assignment
+        peer_tbl = cross.PeerReviewAssignment
+        # every user with every assignment and their peers for it if assigned
+        pairs = list(usr_tbl.select(usr_tbl.username, asmt_tbl.name,
+                                    asmt_tbl.initial_due_date,
+                                    asmt_tbl.final_due_date,
+                                    peer_tbl.reviewee1, peer_tbl.reviewee2)
+                     .join(asmt_tbl, peewee.JOIN.CROSS)
+                     .join(peer_tbl, peewee.JOIN.LEFT_OUTER,
+                           on=((peer_tbl.reviewer == usr_tbl.username) &
+                               (peer_tbl.assignment == asmt_tbl.name)))
+                     .tuples())
+        grd_tbl = cross.Gradeable
+        # sqlite fills in the bare columns of an aggregate query
+        # from the row that the max() was taken from
+        latest = list(grd_tbl.select(grd_tbl, peewee.fn.MAX(grd_tbl.timestamp))
+                      .group_by(grd_tbl.user, grd_tbl.assignment,
+                                grd_tbl.component))
+        # taking the write lock first waits out other writers, sqlite
+        # cannot wait for them once a read has begun the transaction
+        with DB.atomic('IMMEDIATE'):
+            DB.create_tables([cls])
+            cls.delete().execute()
+            for user, name, initial, final, peer1, peer2 in pairs:
+                cls.upsert(user, name, initial, final,
+                           peer1=peer1, peer2=peer2)
+            for gbl in latest:
+                (cls.update({f'{gbl.component}_id': gbl.submission_id,
+                             f'{gbl.component}_timestamp': gbl.timestamp,
+                             **({f'{gbl.component}_feedback': gbl.auto_feedback}
+                                if gbl.component in ('initial', 'final') else {})})
+                 .where((cls.user == gbl.user) &
+                        (cls.assignment == gbl.assignment))
+                 .execute())
+        return cls.select().count()
+
+
+def _fill_dashboard():
+    # orbit.db is only migrated in the orbit container, where the databases
+    # of mailman and denis are mounted and importable under these names
+    import denis.db
+    import mailman.db
+    cross = sqlitedb.Attached(sys.modules[__name__],
+                              mailman=mailman.db, denis=denis.db)
+    try:
+        DashboardRow.rebuild(cross)
+    finally:
+        cross.database.close()
+
+
+# Schema changes made since the first deployment, see sqlitedb.migrate
+# create_tables() only adds tables and indexes that do not exist yet
+MIGRATIONS = [
+    # Session.expiry and Oopsie.assignment indexes, the Revocation table
+    # and the DashboardRow table
+    lambda: DB.create_tables([Session, Oopsie, Revocation, DashboardRow]),
+    # radius only reads dashboards from DashboardRow, so the rows for the
+    # users and assignments that existed before it are filled in
+    _fill_dashboard,
+]
+
+
+def migrate():
+    return sqlitedb.migrate(DB, BaseModel.__subclasses__(), MIGRATIONS)
+
 
 if __name__ == '__main__':
-    DB.create_tables(BaseModel.__subclasses__())
+    print('orbit.db schema version {} -> {}'.format(*migrate()))
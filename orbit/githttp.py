@@ -0,0 +1,96 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+
+import cgit
+import config
+
+# Smart HTTP for fetches and clones, served by `git http-backend`
+#
+# Only upload-pack is ever offered: the routes in radius never hand this a
+# receive-pack request, so nothing here can write to the repositories.
+
+
+def _feed(body, length, stdin):
+    # copy the request body while the response is being read, so that
+    # neither side of the pipe can fill up and stall the other
+    try:
+        while length > 0 and (chunk := body.read(min(length, cgit.CHUNK_SIZE))):
+            stdin.write(chunk)
+            length -= len(chunk)
+    except (OSError, ValueError) as ex:
+        print(f'githttp: request body not delivered: {ex!r}', file=sys.stderr)
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+async def _feed_async(body, stdin):
+    try:
+        async for chunk in body:
+            stdin.write(chunk)
+            await stdin.drain()
+    except (OSError, ValueError) as ex:
+        print(f'githttp: request body not delivered: {ex!r}', file=sys.stderr)
+    finally:
+        stdin.close()
+
+
+def _backend_env(env, path_info, username):
+    backend_env = {
+        'PATH': os.environ.get('PATH', '/usr/bin:/bin'),
+        'GIT_PROJECT_ROOT': config.cgit_scan_path,
+        # the repositories are not marked with git-daemon-export-ok
+        'GIT_HTTP_EXPORT_ALL': '1',
+        # and belong to the git container rather than to us
+        'GIT_CONFIG_COUNT': '1',
+        'GIT_CONFIG_KEY_0': 'safe.directory',
+        'GIT_CONFIG_VALUE_0': '*',
+        'PATH_INFO': path_info,
+        'QUERY_STRING': env.get('QUERY_STRING', ''),
+        'REQUEST_METHOD': env.get('REQUEST_METHOD', 'GET'),
+        'REMOTE_USER': username,
+    }
+    for name in ['CONTENT_TYPE', 'CONTENT_LENGTH', 'HTTP_CONTENT_ENCODING',
+                 'HTTP_GIT_PROTOCOL']:
+        if name in env:
+            backend_env[name] = env[name]
+    return backend_env
+
+
+def run(env, path_info, username):
+    proc = subprocess.Popen(['git', 'http-backend'],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            env=_backend_env(env, path_info, username))
+    feeder = threading.Thread(target=_feed, daemon=True,
+                              args=(env['wsgi.input'],
+                                    int(env.get('CONTENT_LENGTH') or 0),
+                                    proc.stdin))
+    feeder.start()
+
+    def stop():
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        feeder.join()
+    return cgit.Output(proc.stdout, stop, lambda: proc.wait() == 0)
+
+
+# The same for the ASGI application, with the request body an async
+# iterable of chunks and git run as an asyncio subprocess
+async def run_async(env, path_info, username, body):
+    proc = await asyncio.create_subprocess_exec(
+        'git', 'http-backend',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        env=_backend_env(env, path_info, username),
+        limit=cgit.MAX_HEADER_BYTES)
+    feeder = asyncio.create_task(_feed_async(body, proc.stdin))
+    return await cgit.AsyncOutput.start(proc, feeder)
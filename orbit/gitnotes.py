@@ -0,0 +1,261 @@
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+
+import config
+
+
+class CatFile:
+    """
+    CatFile: A long lived `git cat-file --batch-command` coprocess
+             Requests are pipelined: every command in a batch is written
+             before any response is read, so a whole batch costs a single
+             round trip instead of a process spawn per object
+             The coprocess is started lazily so that each uWSGI worker
+             gets its own after forking, and is restarted if it dies
+             Threads of a worker take turns using it
+
+    ...
+
+    Attributes
+    ----------
+
+    git_dir : string
+        Path to the repository objects are read from
+
+    Methods
+    -------
+
+    info(names) : list
+        Get the object id of each named object or None if it is missing
+
+    contents(names) : list
+        Get the contents of each named object as bytes or None if missing
+
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._proc = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        self._proc = subprocess.Popen(['git', '--git-dir', self.git_dir,
+                                       'cat-file', '--batch-command',
+                                       '--buffer'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        self._pid = os.getpid()
+
+    def _kill(self):
+        # a process inherited across fork belongs to our parent, leave it be
+        if self._proc is not None and self._pid == os.getpid():
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+
+    def _alive(self):
+        return (self._proc is not None and self._pid == os.getpid()
+                and self._proc.poll() is None)
+
+    def _read_response(self, with_contents):
+        header = self._proc.stdout.readline()
+        if not header.endswith(b'\n'):
+            raise EOFError('git cat-file exited unexpectedly')
+        oid, *rest = header.split()
+        if rest in ([b'missing'], [b'ambiguous']):
+            return None
+        if not with_contents:
+            return oid.decode()
+        _, size = rest
+        body = self._proc.stdout.read(int(size) + 1)
+        if len(body) != int(size) + 1:
+            raise EOFError('git cat-file exited unexpectedly')
+        return body[:-1]
+
+    def _exchange(self, command, names):
+        if not self._alive():
+            self._kill()
+            self._spawn()
+        request = ''.join(f'{command} {name}\n' for name in names)
+        self._proc.stdin.write(request.encode() + b'flush\n')
+        self._proc.stdin.flush()
+        return [self._read_response(command == 'contents') for _ in names]
+
+    def _batch(self, command, names):
+        if not names:
+            return []
+        # responses are read in the order requests were written,
+        # so an exchange must not be interleaved with another
+        with self._lock:
+            try:
+                return self._exchange(command, names)
+            except (OSError, EOFError, ValueError) as ex:
+                print(f'gitnotes: restarting cat-file after {ex!r}',
+                      file=sys.stderr)
+                self._kill()
+                return self._exchange(command, names)
+
+    def info(self, names):
+        return self._batch('info', names)
+
+    def contents(self, names):
+        return self._batch('contents', names)
+
+
+class NotesIndex:
+    """
+    NotesIndex: In memory map from tag name to note for some notes refs
+                Loaded through a CatFile and only reloaded when a cheap stat
+                of the refs it depends on shows that they may have moved
+                A reload only reads the trees of notes refs that actually
+                moved and the blobs of notes that were not seen before
+                One thread reloads while the others wait for it, lookups
+                see either the old or the new notes of a ref
+
+    ...
+
+    Attributes
+    ----------
+
+    cat_file : CatFile
+        Coprocess used to read the notes trees and blobs
+
+    refs : tuple
+        Names of the notes refs to index, e.g. 'grade' for refs/notes/grade
+
+    Methods
+    -------
+
+    refresh()
+        Reload the index if any of the refs it depends on have moved
+
+    lookup(ref, tag) : string
+        Get the note attached to tag in refs/notes/$ref or None
+
+    version() : string
+        Token that changes whenever any note or tag in the index may have
+
+    """
+
+    def __init__(self, cat_file, refs):
+        self.cat_file = cat_file
+        self.refs = tuple(refs)
+        self._stamp = None
+        self._ref_oids = dict.fromkeys(self.refs)
+        self._tag_oids = {}
+        self._annotations = {ref: {} for ref in self.refs}
+        self._blobs = {}
+        self._notes = {ref: {} for ref in self.refs}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.cat_file.git_dir, name)
+
+    def _stat(self):
+        def stat(name):
+            try:
+                st = os.stat(self._path(name))
+                return st.st_ino, st.st_mtime_ns, st.st_size
+            except FileNotFoundError:
+                return None
+        # updating a loose ref renames a lockfile into place, so the
+        # directory holding it is touched even when the ref is rewritten
+        return tuple(stat(name) for name in
+                     ['packed-refs', 'refs/tags', 'refs/notes',
+                      *[f'refs/notes/{ref}' for ref in self.refs]])
+
+    def _read_refs(self, prefix):
+        refs = {}
+        try:
+            with open(self._path('packed-refs')) as packed:
+                for line in packed:
+                    oid, _, name = line.rstrip('\n').partition(' ')
+                    if name.startswith(prefix):
+                        refs[name] = oid
+        except FileNotFoundError:
+            pass
+        # loose refs take precedence over packed ones
+        for root, _, files in os.walk(self._path(prefix)):
+            for file in files:
+                path = os.path.join(root, file)
+                with open(path) as loose:
+                    oid = loose.read().strip()
+                refs[os.path.relpath(path, self.cat_file.git_dir)] = oid
+        return refs
+
+    def _read_tree(self, ref_oid):
+        # walk the notes tree one level of fanout at a time,
+        # reading all the subtrees of each level in one exchange
+        oid_len = len(ref_oid) // 2
+        annotations = {}
+        level = [('', f'{ref_oid}^{{tree}}')]
+        while level:
+            subtrees = []
+            for (prefix, _), tree in zip(level, self.cat_file.contents(
+                    [name for _, name in level])):
+                pos = 0
+                while tree and pos < len(tree):
+                    nul = tree.index(b'\0', pos)
+                    mode, name = tree[pos:nul].decode().split(' ', 1)
+                    oid = tree[nul + 1:nul + 1 + oid_len].hex()
+                    pos = nul + 1 + oid_len
+                    if mode == '40000':
+                        subtrees.append((prefix + name, oid))
+                    else:
+                        annotations[prefix + name] = oid
+            level = subtrees
+        return annotations
+
+    def _rebuild(self, ref_oids, tag_oids):
+        for ref, oid in ref_oids.items():
+            if oid != self._ref_oids[ref]:
+                self._annotations[ref] = self._read_tree(oid) if oid else {}
+        live = {blob for annotations in self._annotations.values()
+                for blob in annotations.values()}
+        new = [blob for blob in live if blob not in self._blobs]
+        self._blobs = {blob: text for blob, text in self._blobs.items()
+                       if blob in live}
+        for blob, content in zip(new, self.cat_file.contents(new)):
+            if content is not None:
+                self._blobs[blob] = (content.decode(errors='replace')
+                                     .removesuffix('\n'))
+        for ref, annotations in self._annotations.items():
+            self._notes[ref] = {tag: self._blobs.get(annotations[oid])
+                                for tag, oid in tag_oids.items()
+                                if oid in annotations}
+        self._ref_oids = ref_oids
+        self._tag_oids = tag_oids
+        self._version = hashlib.sha256(repr([
+            sorted(ref_oids.items()), sorted(tag_oids.items())
+        ]).encode()).hexdigest()
+
+    def refresh(self):
+        if (stamp := self._stat()) == self._stamp:
+            return
+        with self._lock:
+            if stamp != self._stamp:
+                self._reload(stamp)
+
+    def _reload(self, stamp):
+        notes_refs = self._read_refs('refs/notes/')
+        ref_oids = {ref: notes_refs.get(f'refs/notes/{ref}')
+                    for ref in self.refs}
+        tag_oids = {name.removeprefix('refs/tags/'): oid for name, oid
+                    in self._read_refs('refs/tags/').items()}
+        if ref_oids != self._ref_oids or tag_oids != self._tag_oids:
+            self._rebuild(ref_oids, tag_oids)
+        self._stamp = stamp
+
+    def lookup(self, ref, tag):
+        return self._notes[ref].get(tag)
+
+    def version(self):
+        return self._version
+
+
+grading = NotesIndex(CatFile(config.grading_repo), ['grade', 'feedback'])
@@ -3,12 +3,16 @@
 import argparse
 import bcrypt
 import sys
+import time
 
 from datetime import datetime
 
 # internal imports
 import config
 import db
+import denis.db
+import mailman.db
+import sqlitedb
 
 
 def errx(msg):
@@ -32,6 +36,12 @@ def nou(u):
 
 def do_drop_session(args):
     need(args, u=True)
+    if config.session_mode == 'signed':
+        # every session issued until now expires before this
+        longest = 60 * config.minutes_each_session_token_is_valid
+        db.Revocation.create(username=args.username, token=None,
+                             expiry=time.time() + longest)
+        return
     query = (db.Session
              .delete()
              .where(db.Session.username == args.username))
@@ -40,6 +50,18 @@ def do_drop_session(args):
         errx('No session belonging to that user found')
 
 
+def reap_query(model, now):
+    return model.delete().where(model.expiry < now)
+
+
+def do_reap_sessions(args):
+    now = time.time()
+    query = reap_query(db.Session, now)
+    print(f'Reaped {query.execute()} expired sessions')
+    query = reap_query(db.Revocation, now)
+    print(f'Reaped {query.execute()} expired revocations')
+
+
 def do_change_password(args):
     need(args, u=True, p=True)
     new_hash = do_bcrypt_hash(args)
@@ -66,6 +88,8 @@ def do_delete_user(args):
              .where(db.User.username == args.username))
     if query.execute() < 1:
         nou(args.username)
+    dash_tbl = db.DashboardRow
+    dash_tbl.delete().where(dash_tbl.user == args.username).execute()
 
 
 def do_bcrypt_hash(args):
@@ -84,6 +108,9 @@ def do_newuser(args):
                        student_id=args.studentid, fullname=args.fullname)
     except db.peewee.IntegrityError as e:
         errx(f'cannot create user with duplicate field: "{e}"')
+    for asn in denis.db.Assignment.select():
+        db.DashboardRow.upsert(args.username, asn.name, asn.initial_due_date,
+                               asn.final_due_date)
 
 
 def do_roster(args):
@@ -99,6 +126,37 @@ def do_list_sessions(args):
         print(f'{s.username} until {expiry}: {s.token}')
 
 
+def do_rebuild_dashboard(args):
+    cross = sqlitedb.Attached(db, mailman=mailman.db, denis=denis.db)
+    print(f'Dashboard rebuilt with {db.DashboardRow.rebuild(cross)} rows')
+
+
+def do_explain(args):
+    # imported here as radius reads its templates and sets up its caches
+    import radius
+    cross = sqlitedb.Attached(db, mailman=mailman.db, denis=denis.db)
+    now = time.time()
+    user = args.username or 'user'
+    # the queries built by the code that runs them, with example values
+    queries = {
+        'radius dashboard': radius.dashboard_query(user),
+        'radius activity page': radius.activity_query(user, (int(now), 2**62)),
+        'radius activity version': radius.activity_version_query(user),
+        'radius revocations': radius.revocations_query(now),
+        'hyperspace reap sessions': reap_query(db.Session, now),
+        'mailman submit reviewer': denis.db.PeerReviewAssignment.of('asn', user),
+        'inspector missing': cross.Submission.users_without(cross.User, 'asn'),
+        'denis user_to_sub': cross.Gradeable.latest_of_each_user(
+            cross.User, 'asn', 'initial'),
+        'denis subject tag check': mailman.db.Submission.sent_to('asn', user),
+        'denis final oopsies': db.Oopsie.spent_on('asn'),
+    }
+    for name, query in queries.items():
+        print(f'{name}:')
+        for line in sqlitedb.explain(query):
+            print(f'    {line}')
+
+
 def hyperspace_main(raw_args):
     parser = argparse.ArgumentParser(prog='hyperspace',
                                      description='Administrate Orbit',
@@ -131,6 +189,15 @@ def hyperspace_main(raw_args):
     actions.add_argument('-d', '--dropsession', action='store_const',
                          help='Drop any existing valid session for supplied username',
                          dest='do', const=do_drop_session)
+    actions.add_argument('-e', '--reapsessions', action='store_const',
+                         help='Delete all expired sessions',
+                         dest='do', const=do_reap_sessions)
+    actions.add_argument('-b', '--rebuilddashboard', action='store_const',
+                         help='Regenerate every dashboard row from the submission and assignment databases',
+                         dest='do', const=do_rebuild_dashboard)
+    actions.add_argument('-x', '--explain', action='store_const',
+                         help='Show how sqlite runs the most frequent queries',
+                         dest='do', const=do_explain)
 
     args = parser.parse_args(raw_args)
     if (args.do):
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# render the documents under doc_root ahead of time
+#
+# Each document becomes the page header and rendered body in one file and
+# a compressed copy of the same, radius appends the per-request footer when
+# serving them. The manifest records the source each artifact was built
+# from, so only documents that changed are rendered again.
+
+import argparse
+import json
+import markdown
+import os
+import sys
+import time
+
+# internal imports
+import compress
+import config
+import templates
+
+_manifest_name = 'manifest.json'
+
+
+def render(md):
+    html = markdown.markdown(md, extensions=['tables', 'fenced_code',
+                                             'footnotes', 'toc'])
+    # Use the first line of the document as the title, sans #
+    if (title_end := md.find('\n')) != -1:
+        title = md[0:title_end].lstrip('#').strip()
+    else:
+        title = 'KDLP'
+    return html, title
+
+
+def build_page(header, md):
+    html, title = render(md)
+    return templates.render(templates.Template(header), title=title) + html.encode()
+
+
+def _artifact(name):
+    return os.path.join(config.prerender_root, name.lstrip('/') + '.html')
+
+
+def _stamp(stat):
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+# Get the artifact for the document at name (relative to doc_root) if it was
+# built from the source described by stat, compressed when gzip is true
+def load(name, stat, gzip=False):
+    path = _artifact(name) + ('.deflate' if gzip else '')
+    try:
+        with open(path, 'rb') as file:
+            # artifacts carry the mtime of the source they were built from
+            if os.fstat(file.fileno()).st_mtime_ns != stat.st_mtime_ns:
+                return None
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write(path, data, mtime_ns):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.utime(tmp, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp, path)
+
+
+def _build_one(name, stat, header):
+    with open(os.path.join(config.doc_root, name)) as file:
+        page = build_page(header, file.read())
+    path = _artifact(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write(f'{path}.deflate', compress.deflate_prefix(page), stat.st_mtime_ns)
+    _write(path, page, stat.st_mtime_ns)
+
+
+def _remove(name):
+    for path in [_artifact(name), _artifact(name) + '.deflate']:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def build(force=False):
+    manifest_path = os.path.join(config.prerender_root, _manifest_name)
+    try:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    with open(config.doc_header) as file:
+        header = file.read()
+    # every page includes the header, so changing it changes them all
+    header_stamp = _stamp(os.stat(config.doc_header))
+    force = force or manifest.get('header') != header_stamp
+    built = manifest.get('docs', {}) if not force else {}
+    sources = {}
+    for root, _, files in os.walk(config.doc_root):
+        for file in files:
+            if file.endswith('.md'):
+                path = os.path.join(root, file)
+                sources[os.path.relpath(path, config.doc_root)] = os.stat(path)
+    rendered = 0
+    for name, stat in sources.items():
+        if built.get(name) != _stamp(stat):
+            _build_one(name, stat, header)
+            rendered += 1
+    for name in manifest.get('docs', {}).keys() - sources.keys():
+        _remove(name)
+    os.makedirs(config.prerender_root, exist_ok=True)
+    _write(manifest_path, json.dumps({
+        'header': header_stamp,
+        'docs': {name: _stamp(stat) for name, stat in sources.items()},
+    }).encode(), time.time_ns())
+    return rendered
+
+
+def prerender_main(argv):
+    parser = argparse.ArgumentParser(prog='prerender',
+                                     description='Render Orbit documents ahead of time',
+                                     epilog=f'{config.version_info}')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Render every document even if it is unchanged')
+    parser.add_argument('-w', '--watch', type=float, metavar='SECONDS',
+                        help='Keep checking for changes this often')
+    args = parser.parse_args(argv)
+    print(f'Rendered {build(args.force)} documents')
+    while args.watch:
+        time.sleep(args.watch)
+        if (rendered := build()):
+            print(f'Rendered {rendered} documents')
+
+
+if __name__ == "__main__":
+    prerender_main(sys.argv[1:])
@@ -3,39 +3,132 @@
 # it's all one things now
 
 import base64
-import bcrypt
-import git
-import html
-import markdown
+import email.utils
+import hashlib
+import hmac
+import itertools
+import math
 import os
-import subprocess
 import sys
 import secrets
+import threading
+import time
 from http import HTTPStatus, cookies
 from datetime import datetime, timedelta
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, urlencode, urlparse
 
 # === internal imports & constants ===
+import authcache
+import bcryptd
+import cache
+import cgit
+import compress
 import config
 import db
+import githttp
+import gitnotes
 import mailman.db
 import denis.db
+import prerender
+import ratelimit
+import templates
 
 sec_per_min = 60
 min_per_ses = config.minutes_each_session_token_is_valid
 
 with open(config.doc_header) as header:
     html_header = header.read()
+page_header_template = templates.Template(html_header)
+page_footer_template = templates.Template("""
+        <hr>
+        <code>msg = {msg}</code><br>
+        <code>whoami = {whoami}</code><br>
+        <code>{version_info}</code><br>
+        <hr>
+        </body>
+        </html>
+        """)
+
+
+# Whether another connection has committed to orbit.db since the calling
+# thread last asked, versions holding what each thread saw last time, as
+# data_version only compares between queries on the same connection
+def orbit_db_changed(versions):
+    data_version, = db.DB.execute_sql('PRAGMA data_version').fetchone()
+    if data_version == versions.get(thread := threading.get_ident()):
+        return False
+    versions[thread] = data_version
+    return True
+
+
+class SessionCache(cache.TTLCache):
+    """
+    SessionCache: TTLCache of the sessions recently loaded by this worker
+                  Emptied when another connection has written to orbit.db,
+                  checked at most every config.revocation_check_seconds,
+                  so a session ended by one worker is soon dropped by all
+
+    """
+
+    def __init__(self, max_entries, ttl):
+        super().__init__(max_entries, ttl)
+        self._checked = 0
+        self._data_versions = {}
+
+    def get(self, key, default=None):
+        if (now := time.time()) - self._checked >= config.revocation_check_seconds:
+            self._checked = now
+            if orbit_db_changed(self._data_versions):
+                self.clear()
+        return super().get(key, default)
+
+
+# token -> (username, expiry) for sessions recently loaded by this worker
+session_cache = SessionCache(config.session_cache_entries,
+                             config.session_cache_seconds)
+
+# (path, mtime, size) -> (html, title) for documents rendered by this worker
+md_cache = cache.TTLCache(config.md_cache_entries, float('inf'))
 
 # === utilities ===
 
 
-def check_credentials(username, password):
+# Derive an entity tag from everything that a response depends on
+def mk_etag(*parts):
+    return hashlib.sha256('\0'.join(map(str, parts)).encode()).hexdigest()[:32]
+
+
+# secret for the keyed hashes naming cached credential checks, generated in
+# the uWSGI master before forking so that all the workers share it
+credential_cache_key = secrets.token_bytes(32)
+
+
+def credential_cache_entry(username, password, pwdhash):
+    # the stored hash is part of the key so that changing or clearing a
+    # password with hyperspace invalidates everything cached for the old one
+    msg = '\0'.join((username, password, pwdhash)).encode()
+    return hmac.new(credential_cache_key, msg, hashlib.sha256).digest()
+
+
+def check_credentials(username, password, source=None):
     if not (user := db.User.get_or_none(db.User.username == username)):
         return False
     if not user.pwdhash:
         return False
-    return bcrypt.checkpw(password.encode(), user.pwdhash.encode())
+    entry = credential_cache_entry(username, password, user.pwdhash)
+    if (verdict := authcache.get_entry(entry)) is not None:
+        ok = verdict == b'1'
+        authcache.touch_entry(entry, config.credential_cache_seconds if ok
+                              else config.credential_failure_cache_seconds)
+        return ok
+    # only attempts that would cost a bcrypt check are rate limited
+    ratelimit.throttle(username, source)
+    if bcryptd.checkpw(password, user.pwdhash):
+        authcache.add_entry(entry, b'1', config.credential_cache_seconds)
+        return True
+    ratelimit.failed(username, source)
+    authcache.add_entry(entry, b'0', config.credential_failure_cache_seconds)
+    return False
 
 
 # === user session handling ===
@@ -74,6 +167,9 @@ class Session:
     expired()
         Get truth of whether this $self.expiry is in the past
 
+    forget()
+        Clear this session from memory, leaving the database untouched
+
     expiry_fmt()
         Get a printable, formatted string of $self.expiry
 
@@ -90,29 +186,43 @@ class Session:
         # initialize session from username and add new database entry
         if username:
             self.username = username
-            self.token = self.mk_hash(username)
             self.expiry = datetime.now() + timedelta(minutes=min_per_ses)
-            # creates a new session if one does not exist
-            (db.Session
-             .replace(username=self.username,
-                      token=self.token,
-                      expiry=self.expiry_ts())
-             .execute())
-
-        # try to load active session from database using user token
-        else:
-            if (raw := env.get("HTTP_COOKIE", None)):
-                cok = cookies.BaseCookie('')
-                cok.load(raw)
-                res = cok.get('auth', cookies.Morsel()).value
-
-                if (ses_found := db.Session.get_or_none(db.Session.token == res)):
-                    self.token = ses_found.token
-                    self.username = ses_found.username
-                    self.expiry = datetime.fromtimestamp(ses_found.expiry)
+            self.token = self.mk_hash(username)
+            self.store()
+
+        # try to load active session using user token
+        elif env and (raw := env.get("HTTP_COOKIE", None)):
+            cok = cookies.BaseCookie('')
+            cok.load(raw)
+            if (res := cok.get('auth', cookies.Morsel()).value):
+                self.load(res)
+
+    def store(self):
+        # creates a new session if one does not exist
+        (db.Session
+         .replace(username=self.username,
+                  token=self.token,
+                  expiry=self.expiry_ts())
+         .execute())
+
+    def load(self, token):
+        if (found := session_cache.get(token)) is None:
+            if (ses_found := db.Session.get_or_none(db.Session.token == token)):
+                found = (ses_found.username, ses_found.expiry)
+                session_cache.put(token, found, ses_found.expiry)
+        if found is not None:
+            self.token = token
+            self.username, expiry = found
+            self.expiry = datetime.fromtimestamp(expiry)
 
     def end(self):
         db.Session.delete().where(db.Session.token == self.token).execute()
+        self.forget()
+
+    # drop the session from this object without touching the database,
+    # expired rows are purged in bulk by `hyperspace.py --reapsessions`
+    def forget(self):
+        session_cache.pop(self.token)
         self.token = None
         self.username = None
         self.expiry = None
@@ -126,7 +236,7 @@ class Session:
 
     def expired(self):
         if (expiry := self.expiry) is None or datetime.now() > expiry:
-            self.end()
+            self.forget()
             return True
         else:
             return False
@@ -139,7 +249,7 @@ class Session:
 
     def mk_cookie_header(self):
         if self.token is None:
-            return [('Set-Cookie', 'auth=')]
+            return [('Set-Cookie', 'auth=; Max-Age=0; Path=/')]
         cookie_fmt = 'auth={}; Max-Age={}; Path=/'
         max_age = sec_per_min * min_per_ses
         cookie_val = cookie_fmt.format(self.token, max_age)
@@ -147,6 +257,140 @@ class Session:
         return [('Set-Cookie', cookie_val)]
 
 
+def revocations_query(now):
+    return db.Revocation.select().where(db.Revocation.expiry >= now)
+
+
+class Revocations:
+    """
+    Revocations: In memory copy of the session revocation table
+                 Reloaded when another connection has written to orbit.db,
+                 checked at most every config.revocation_check_seconds
+
+    ...
+
+    Methods
+    -------
+
+    revoke(username, token, expiry)
+        Revoke token (or every token of username if token is None) whose
+        expiry is no later than expiry
+
+    revoked(username, token, expiry)
+        Get truth of whether a token carrying username and expiry is revoked
+
+    """
+
+    def __init__(self):
+        self._checked = 0
+        self._data_versions = {}
+        self._tokens = set()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(tokens, users, username, token, expiry):
+        if token is not None:
+            tokens.add(token)
+        elif expiry > users.get(username, 0):
+            users[username] = expiry
+
+    def _refresh(self):
+        if (now := time.time()) - self._checked < config.revocation_check_seconds:
+            return
+        self._checked = now
+        if not orbit_db_changed(self._data_versions):
+            return
+        # other threads keep checking against the old copy until it is whole
+        tokens, users = set(), {}
+        for row in revocations_query(now):
+            self._add(tokens, users, row.username, row.token, row.expiry)
+        self._tokens, self._users = tokens, users
+
+    def revoke(self, username, token, expiry):
+        db.Revocation.create(username=username, token=token, expiry=expiry)
+        with self._lock:
+            self._add(self._tokens, self._users, username, token, expiry)
+
+    def revoked(self, username, token, expiry):
+        with self._lock:
+            self._refresh()
+            return (token in self._tokens or
+                    expiry <= self._users.get(username, 0))
+
+
+class SignedSession(Session):
+    """
+    SignedSession: Stateless user session management
+                   Used instead of Session when config.session_mode is 'signed'
+                   The token carries the username and expiry and is signed
+                   with an HMAC, so checking one needs no database read
+                   Logging out records the token in the revocation table
+
+    """
+
+    key = None
+
+    def store(self):
+        pass
+
+    def load(self, token):
+        try:
+            user_b64, expiry_str, nonce, mac = token.split('.')
+            expiry = int(expiry_str)
+            username = base64.urlsafe_b64decode(user_b64).decode()
+        except (ValueError, UnicodeDecodeError):
+            return
+        if not hmac.compare_digest(mac, self.sign(user_b64, expiry, nonce)):
+            return
+        if revocations.revoked(username, mac, expiry):
+            return
+        self.token = token
+        self.username = username
+        self.expiry = datetime.fromtimestamp(expiry)
+
+    def end(self):
+        mac = self.token.rsplit('.', 1)[-1]
+        revocations.revoke(self.username, mac, self.expiry_ts())
+        self.forget()
+
+    @classmethod
+    def sign(cls, user_b64, expiry, nonce):
+        msg = f'{user_b64}.{expiry}.{nonce}'.encode()
+        return hmac.new(cls.key, msg, hashlib.sha256).hexdigest()
+
+    def mk_hash(self, username):
+        user_b64 = base64.urlsafe_b64encode(username.encode()).decode()
+        # the token only carries whole seconds
+        expiry = int(self.expiry_ts())
+        self.expiry = datetime.fromtimestamp(expiry)
+        # keep tokens issued within the same second distinct
+        nonce = secrets.token_hex(8)
+        mac = self.sign(user_b64, expiry, nonce)
+        return f'{user_b64}.{expiry}.{nonce}.{mac}'
+
+
+def load_session_key(path):
+    # the first process to get here creates the key, the rest read it
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as file:
+            return file.read()
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(key)
+    return key
+
+
+if config.session_mode == 'signed':
+    SignedSession.key = load_session_key(config.session_key_file)
+    revocations = Revocations()
+    session_type = SignedSession
+else:
+    session_type = Session
+
+
 class Rocket:
     """
     Rocket: Radius user request context (responsible for authentication)
@@ -198,11 +442,19 @@ class Rocket:
         self._msg = "(silence)"
         # HTTP response headers specified by list of string pairs
         self.headers = []
-        self.body_args = self.read_body_args_wsgi()
+        self._body_args = None
 
     def msg(self, msg):
         self._msg = msg
 
+    # the body is only parsed as a form when a handler asks for it,
+    # others are free to read wsgi.input themselves
+    @property
+    def body_args(self):
+        if self._body_args is None:
+            self._body_args = self.read_body_args_wsgi()
+        return self._body_args
+
     def len_body(self):
         return int(self.env.get('CONTENT_LENGTH', "0"))
 
@@ -216,11 +468,11 @@ class Rocket:
     @property
     def session(self):
         if self._session is None:
-            self._session = Session(env=self.env)
-        # if the session is invalid, clear the user cookie
-        if not self._session.valid():
-            self.headers += self._session.mk_cookie_header()
-        else:
+            self._session = session_type(env=self.env)
+            # if the session is invalid, clear the user cookie once
+            if not self._session.valid():
+                self.headers += self._session.mk_cookie_header()
+        if self._session.valid():
             return self._session
 
     @property
@@ -228,9 +480,14 @@ class Rocket:
         if session := self.session:
             return session.username
 
+    # client address that nginx forwarded, if it told us
+    @property
+    def source(self):
+        return self.env.get('HTTP_X_FORWARDED_FOR')
+
+    # values are as the client sent them, templates escape what they output
     def body_args_query(self, key):
-        return html.escape(
-            self.body_args.get(key.encode(), [b''])[0].decode())
+        return self.body_args.get(key.encode(), [b''])[0].decode()
 
     def queries_query(self, key):
         return self.queries.get(key, [''])[0]
@@ -241,8 +498,8 @@ class Rocket:
         if self.method == "POST":
             username = self.body_args_query('username')
             password = self.body_args_query('password')
-            if (check_credentials(username, password)):
-                new_ses = Session(username=username)
+            if (check_credentials(username, password, self.source)):
+                new_ses = session_type(username=username)
             if new_ses:
                 self._session = new_ses
                 self.headers += self._session.mk_cookie_header()
@@ -253,42 +510,82 @@ class Rocket:
         self._session.end()
         self.headers += self._session.mk_cookie_header()
 
-    def format_html(self, doc, title):
+    def page_header(self, title):
+        return templates.render(page_header_template, title=title)
+
+    def page_footer(self):
         # loads cookie if exists
         self.session
-        page_header = html_header.format(title=title)
-        return page_header + doc + f"""
-        <hr>
-        <code>msg = {self._msg}</code><br>
-        <code>whoami = {self.username}</code><br>
-        <code>{config.version_info}</code><br>
-        <hr>
-        </body>
-        </html>
-        """
+        return templates.render(page_footer_template, msg=self._msg,
+                                whoami=self.username,
+                                version_info=config.version_info)
+
+    # Attach validators for the response and check them against the
+    # conditional headers of the request, if the client's copy is still
+    # current it can be answered with 304 Not Modified and no body
+    def not_modified(self, etag, mtime=None):
+        etag = f'"{etag}"'
+        # weak, as the same content may be sent compressed or not, and so
+        # the same on a 200 and a 304 whatever the middleware does
+        self.headers += [('ETag', f'W/{etag}')]
+        if mtime is not None:
+            self.headers += [('Last-Modified',
+                              email.utils.formatdate(mtime, usegmt=True))]
+        if (match := self.env.get('HTTP_IF_NONE_MATCH')) is not None:
+            return match.strip() == '*' or etag in (
+                tag.strip().removeprefix('W/') for tag in match.split(','))
+        # only consulted without If-None-Match, as the date alone cannot
+        # tell whether anything besides the document itself has changed
+        if mtime is not None and (
+                since := self.env.get('HTTP_IF_MODIFIED_SINCE')):
+            try:
+                since = email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
 
     def raw_respond(self, response_code, body=b''):
+        return self.stream_respond(response_code, [body])
+
+    # Respond with an iterable of byte chunks sent as they are produced
+    def stream_respond(self, response_code, body):
         self._start_response(f'{response_code.value} {response_code.phrase}',
                              self.headers)
-        return [body]
+        return body
 
-    def respond(self, response_document, title=None):
+    # Finish a page rendered ahead of time by prerender.py, which may
+    # already be compressed
+    def respond_prerendered(self, page, gzip=False):
+        self.headers += [('Content-Type', 'text/html')]
+        footer = self.page_footer()
+        if gzip:
+            self.headers += [('Content-Encoding', 'gzip')]
+            return self.raw_respond(HTTPStatus.OK,
+                                    compress.gzip_splice(page, footer))
+        return self.raw_respond(HTTPStatus.OK, page + footer)
+
+    # Respond with a page whose body is an iterable of byte chunks, such as
+    # a rendered template, which is sent as it is produced
+    def respond_chunks(self, chunks, title=None):
         if title is None:
             title = 'KDLP'
         self.headers += [('Content-Type', 'text/html')]
-        response_document = self.format_html(response_document, title)
-        return self.raw_respond(HTTPStatus.OK, response_document.encode())
+        # the footer may clear the cookie, which must happen before
+        # the headers are sent
+        footer = self.page_footer()
+        return self.stream_respond(HTTPStatus.OK, templates.buffered(
+            itertools.chain([self.page_header(title)], chunks, [footer])))
 
 
-def mk_form_welcome(session):
-    return f'''
+welcome_form = templates.Template("""
     <div class="logout_info">
         <div class="logout_left">
             <table>
                 <tr><th>Cookie Key</th><th>Value</th></tr>
-                <tr><td>Token</td><td>{session.token}</td></tr>
-                <tr><td>User</td><td>{session.username}</td></tr>
-                <tr><td>Expiry</td><td>{session.expiry_fmt()}</td></tr>
+                <tr><td>Token</td><td>{token}</td></tr>
+                <tr><td>User</td><td>{username}</td></tr>
+                <tr><td>Expiry</td><td>{expiry}</td></tr>
             </table>
         </div>
         <div class="logout_right">
@@ -299,16 +596,10 @@ def mk_form_welcome(session):
         <form id="logout" method="get" action="/logout">
             <input class="logout" type="submit" value="Logout" />
         </form>
-    </div>'''
+    </div>""")
 
-
-def login_form(target_location=None):
-    if target_location is not None:
-        target_redir = f'?target={target_location}'
-    else:
-        target_redir = ''
-    return f'''
-    <form id="login" method="post" action="/login{target_redir}">
+login_form_template = templates.Template("""
+    <form id="login" method="post" action="/login{query}">
         <label for="username">Username:<br /></label>
         <input name="username" type="text" id="username" />
     <br />
@@ -317,7 +608,21 @@ def login_form(target_location=None):
     <br />
         <button type="submit">Submit</button>
     </form>
-    <h3>Need an account? Register <a href="/register">here</a></h3><br>'''
+    <h3>Need an account? Register <a href="/register">here</a></h3><br>""")
+
+
+def mk_form_welcome(session):
+    return templates.render(welcome_form, token=session.token,
+                            username=session.username,
+                            expiry=session.expiry_fmt())
+
+
+def login_form(target_location=None):
+    if target_location is not None:
+        query = f'?{urlencode({"target": target_location})}'
+    else:
+        query = ''
+    return templates.render(login_form_template, query=query)
 
 
 def handle_login(rocket):
@@ -334,11 +639,13 @@ def handle_login(rocket):
             rocket.headers += [('Location', target)]
             return rocket.raw_respond(HTTPStatus.SEE_OTHER)
         elif target:
-            return rocket.respond(login_form(target_location=target), 'Login')
+            return rocket.respond_chunks([login_form(target_location=target)],
+                                         'Login')
         elif welcome:
-            return rocket.respond(mk_form_welcome(rocket.session), 'Welcome')
+            return rocket.respond_chunks([mk_form_welcome(rocket.session)],
+                                         'Welcome')
         else:
-            return rocket.respond(login_form(), 'Login')
+            return rocket.respond_chunks([login_form()], 'Login')
 
     if rocket.session:
         rocket.msg(f'{rocket.username} authenticated by token')
@@ -365,8 +672,14 @@ def handle_mail_auth(rocket):
             or method != 'plain':
         return rocket.raw_respond(HTTPStatus.BAD_REQUEST)
 
-    if not check_credentials(username, password):
-        return rocket.raw_respond(HTTPStatus.UNAUTHORIZED)
+    try:
+        if not check_credentials(username, password, rocket.source):
+            return rocket.raw_respond(HTTPStatus.UNAUTHORIZED)
+    except ratelimit.Limited as ex:
+        # nginx turns this into a temporary failure asking the
+        # mail client to wait this long before trying again
+        rocket.headers += [('Auth-Wait', str(math.ceil(ex.wait)))]
+        return rocket.raw_respond(HTTPStatus.FORBIDDEN)
 
     return rocket.raw_respond(HTTPStatus.OK)
 
@@ -378,32 +691,86 @@ def handle_logout(rocket):
     return rocket.raw_respond(HTTPStatus.FOUND)
 
 
+stub_page = templates.Template(
+    '<h3>Development stub for {method} {path} </h3>{more}')
+
+
+# more is HTML to add after the heading
 def handle_stub(rocket, more=[]):
-    meth_path = f'{rocket.method} {rocket.path_info}'
-    content = f'<h3>Development stub for {meth_path} </h3>{"".join(more)}'
     rocket.msg('oops')
-    return rocket.respond(content)
+    return rocket.respond_chunks([templates.render(
+        stub_page, method=rocket.method, path=rocket.path_info,
+        more=templates.Markup(''.join(more)))])
+
+
+# Submissions are only ever added, and then have their in_reply_to and
+# status filled in once each, so counting those covers every change
+def activity_version_query(username):
+    sub_tbl = mailman.db.Submission
+    fn = db.peewee.fn
+    return (sub_tbl.select(fn.COUNT(sub_tbl.id), fn.MAX(sub_tbl.id),
+                           fn.COUNT(sub_tbl.status),
+                           fn.COUNT(sub_tbl.in_reply_to))
+            .where(sub_tbl.user == username))
+
+
+def activity_version(username):
+    return activity_version_query(username).tuples().get()
+
+
+# A page of the activity of a user, newest first, starting after the
+# (timestamp, id) of the last row shown before if any
+def activity_query(username, before=None):
+    sub_tbl = mailman.db.Submission
+    query = (sub_tbl.select()
+             .where(sub_tbl.user == username)
+             .order_by(sub_tbl.timestamp.desc(), sub_tbl.id.desc())
+             .limit(config.activity_page_size + 1))
+    if before:
+        query = query.where(db.peewee.Tuple(sub_tbl.timestamp, sub_tbl.id) <
+                            db.peewee.Tuple(*before))
+    return query
 
 
 def handle_activity(rocket):
     if not rocket.session:
         return rocket.raw_respond(HTTPStatus.FORBIDDEN)
 
-    submissions = (mailman.db.Submission.select()
-                   .where(mailman.db.Submission.user == rocket.session.username)
-                   .order_by(-mailman.db.Submission.timestamp))
-
-    def submission_fields(sub):
-        return (datetime.fromtimestamp(sub.timestamp).astimezone().isoformat(),
-                sub.recipient, sub.email_count, sub.in_reply_to or '-',
-                sub.submission_id, sub.status or '-')
+    rocket.headers += [('Cache-Control', 'private, no-cache')]
+    if rocket.not_modified(mk_etag(*activity_version(rocket.username),
+                                   rocket.env.get('QUERY_STRING', ''),
+                                   rocket.username, config.version_info)):
+        return rocket.raw_respond(HTTPStatus.NOT_MODIFIED)
 
-    # Split data from Submission table into values for HTML table
-    table_data = [[f'<td>{val}</td>' for val in submission_fields(sub)]
-                  for sub in submissions]
-    table_content = '</tr>\n<tr>'.join(''.join(row) for row in table_data)
-
-    return rocket.respond(f"""
+    # pages are found by the (timestamp, id) of the last row shown before
+    if (before := rocket.queries_query('before')):
+        try:
+            timestamp, sub_id = map(int, before.split('-'))
+        except ValueError:
+            return rocket.raw_respond(HTTPStatus.BAD_REQUEST)
+        before = (timestamp, sub_id)
+    query = activity_query(rocket.session.username, before)
+
+    def rows():
+        last = None
+        for count, sub in enumerate(query.iterator()):
+            if count == config.activity_page_size:
+                yield from activity_older.render(
+                    before=f'{last.timestamp}-{last.id}')
+                return
+            last = sub
+            yield from activity_row.render(
+                timestamp=datetime.fromtimestamp(sub.timestamp).astimezone().isoformat(),
+                recipient=sub.recipient, email_count=sub.email_count,
+                in_reply_to=sub.in_reply_to or '-',
+                submission_id=sub.submission_id, status=sub.status or '-')
+        yield b'</table>'
+
+    return rocket.respond_chunks(itertools.chain([activity_head], rows()),
+                                 'Activity Log')
+
+
+activity_head = b"""
     <table>
     <tr>
       <th>Timestamp</th>
@@ -413,9 +780,17 @@ def handle_activity(rocket):
       <th>Submission ID</th>
       <th>Status</th>
     </tr>
-    <tr>{table_content}</tr>
+    """
+
+activity_row = templates.Template("""<tr><td>{timestamp}</td><td>{recipient}</td>\
+<td>{email_count}</td><td>{in_reply_to}</td><td>{submission_id}</td>\
+<td>{status}</td></tr>
+""")
+
+activity_older = templates.Template("""
     </table>
-    """, "Activity Log")
+    <a href="/activity?before={before}">Older</a>
+    """)
 
 
 class OopsStatus:
@@ -425,20 +800,94 @@ class OopsStatus:
     UNAVAILABLE = 3
 
 
-class AsmtTable:
-    def __init__(self, assignment, oopsieness, peer1, peer2, init,
-                 review1, review1_grade, review2, review2_grade, final, final_grade, human_feedback):
-        self.assignment = assignment
-        self.name = assignment.name
+asmt_table = templates.Template("""
+        <table>
+          <caption><h3>{name}</h3></caption>
+          <tr>
+            <th>Total Score: {total_score}</th>
+            <th>Timestamp</th>
+            <th>Submission ID</th>
+            <th>Request an 'Oopsie'</th>
+          </tr>
+          {body}
+        </table>
+        <br>
+        """)
+
+gradeable_row = templates.Template("""
+        <tr>
+          <th>
+            {item_name}
+          </th>
+          <td>
+            {timestamp}
+          </td>
+          <td>
+            {submission_id}
+          </td>
+          <th>
+            {rightmost_col}
+          </th>
+        </tr>
+        """)
+
+feedback_row = templates.Template("""
+          <tr>
+            <th>{label}</th>
+            <td colspan="3">{feedback}</td>
+          </tr>
+        """)
+
+peer_review_head = b"""
+          <tr>
+            <th></th>
+            <th>Timestamp</th>
+            <th>Submission ID</th>
+            <th>Score</th>
+          </tr>
+        """
+
+oopsie_button = templates.Template("""
+        <button {disabled}
+         title='{hover}' type="submit" name="oopsie"
+         value="{name}">
+           Oopsie!
+         </button>
+        """)
+
+
+class AsmtView:
+    """
+    AsmtView: What the dashboard shows a user about one assignment
+              Rendered through the templates above, so every value that
+              goes into the page is escaped unless it is markup
+
+    ...
+
+    Attributes
+    ----------
+
+    row : DashboardRow
+        The user's dashboard row for the assignment
+
+    Methods
+    -------
+
+    render() : generator
+        Yield the table for the assignment as bytes
+
+    """
+
+    __slots__ = ('row', 'name', 'oopsieness', 'review1_grade',
+                 'review2_grade', 'final_grade', 'human_feedback')
+
+    def __init__(self, row, oopsieness, review1_grade, review2_grade,
+                 final_grade, human_feedback):
+        self.row = row
+        self.name = row.assignment
         self.oopsieness = oopsieness
-        self.peer1 = peer1
-        self.peer2 = peer2
-        self.init = init
-        self.review1 = review1
         self.review1_grade = review1_grade
-        self.review2 = review2
         self.review2_grade = review2_grade
-        self.final = final
         self.final_grade = final_grade
         self.human_feedback = human_feedback
 
@@ -454,20 +903,23 @@ class AsmtTable:
             case OopsStatus.UNAVAILABLE:
                 return "You have already used your oopsie"
 
-    def get_automated_feedback(self, attr):
-        if attr not in ['init', 'final'] or (gbl := getattr(self, attr)) is None:
-            return 'No submission'
-
-        match attr:
-            case 'init':
-                due_date = int(self.assignment.initial_due_date)
+    def get_automated_feedback(self, component):
+        match component:
+            case 'initial':
+                due_date = int(self.row.initial_due_date)
+                feedback = self.row.initial_feedback
             case 'final':
-                due_date = int(self.assignment.final_due_date)
+                due_date = int(self.row.final_due_date)
+                feedback = self.row.final_feedback
+            case _:
+                return 'No submission'
+        if getattr(self.row, f'{component}_id') is None:
+            return 'No submission'
 
         if due_date <= int(datetime.now().timestamp()):
-            return gbl.auto_feedback
+            return feedback
 
-        match gbl.auto_feedback[-1]:
+        match feedback[-1]:
             case '.':
                 return 'Submission received, no issues detected'
             case '?':
@@ -483,10 +935,10 @@ class AsmtTable:
         try:
             weighted_sum += 0.8 * int(self.final_grade)
             sum_of_weights += 0.8
-            if self.peer1 is not None:
+            if self.row.peer1 is not None:
                 weighted_sum += 0.1 * int(self.review1_grade)
                 sum_of_weights += 0.1
-            if self.peer2 is not None:
+            if self.row.peer2 is not None:
                 weighted_sum += 0.1 * int(self.review2_grade)
                 sum_of_weights += 0.1
         # if any of the grades are None, attempting to cast to int throws a TypeError
@@ -496,112 +948,108 @@ class AsmtTable:
             return '???'
         return f'{weighted_sum/sum_of_weights:.1f}'
 
-    def gradeable_row(self, item_name, gradeable, rightmost_col):
-        return f"""
-        <tr>
-          <th>
-            {item_name}
-          </th>
-          <td>
-            {datetime.fromtimestamp(gradeable.timestamp).astimezone().isoformat() if gradeable else '-'}
-          </td>
-          <td>
-            {gradeable.submission_id if gradeable else '-'}
-          </td>
-          <th>
-            {rightmost_col}
-          </th>
-        </tr>
-        """
+    def gradeable_row(self, item_name, component, rightmost_col):
+        timestamp = getattr(self.row, f'{component}_timestamp')
+        submission_id = getattr(self.row, f'{component}_id')
+        return gradeable_row.render(
+            item_name=item_name,
+            timestamp=datetime.fromtimestamp(timestamp).astimezone().isoformat() if submission_id else '-',
+            submission_id=submission_id or '-',
+            rightmost_col=rightmost_col)
+
+    def feedback_row(self, label, feedback):
+        return feedback_row.render(label=label, feedback=feedback)
 
     def oopsie_button(self):
-        return f"""
-        <button {'disabled' if self.oopsieness != OopsStatus.AVAILABLE else ''}
-         title='{self.oops_button_hover()}' type="submit" name="oopsie"
-         value="{self.name}">
-           Oopsie!
-         </button>
-        """
+        disabled = self.oopsieness != OopsStatus.AVAILABLE
+        return oopsie_button.render(
+            disabled=templates.Markup('disabled' if disabled else ''),
+            hover=self.oops_button_hover(), name=self.name)
 
     def body(self):
         if self.oopsieness == OopsStatus.USED_HERE:
-            return f"""
-              {self.gradeable_row('Final Submission', self.final, self.oopsie_button())}
-              <tr>
-                <th>Automated Feedback</th>
-                <td colspan="3">{self.get_automated_feedback('final')}</td>
-              </tr>
-              <tr>
-                <th>Human Feedback</th>
-                <td colspan="3">{self.human_feedback}</td>
-              </tr>
-            """
-        if (not self.init or
+            yield from self.gradeable_row('Final Submission', 'final', self.oopsie_button())
+            yield from self.feedback_row('Automated Feedback', self.get_automated_feedback('final'))
+            yield from self.feedback_row('Human Feedback', self.human_feedback)
+            return
+        yield from self.gradeable_row('Initial Submission', 'initial', self.oopsie_button())
+        yield from self.feedback_row('Automated Feedback', self.get_automated_feedback('initial'))
+        if (not self.row.initial_id or
             (int(datetime.now().timestamp())
-             < self.assignment.initial_due_date)):
-            return f"""
-              {self.gradeable_row('Initial Submission', self.init, self.oopsie_button())}
-              <tr>
-                <th>Automated Feedback</th>
-                <td colspan="3">{self.get_automated_feedback('init')}</td>
-              </tr>
-            """
-        return f"""
-          {self.gradeable_row('Initial Submission', self.init, self.oopsie_button())}
-          <tr>
-            <th>Automated Feedback</th>
-            <td colspan="3">{self.get_automated_feedback('init')}</td>
-          </tr>
-          <tr>
-            <th></th>
-            <th>Timestamp</th>
-            <th>Submission ID</th>
-            <th>Score</th>
-          </tr>
-          {self.gradeable_row(self.peer1 + ' Peer Review', self.review1, self.review1_grade if self.review1_grade else '-') if self.peer1 else ''}
-          {self.gradeable_row(self.peer2 + ' Peer Review', self.review2, self.review2_grade if self.review2_grade else '-') if self.peer2 else ''}
-          {self.gradeable_row('Final Submission', self.final, self.final_grade if self.final_grade else '-')}
-          <tr>
-            <th>Automated Feedback</th>
-            <td colspan="3">{self.get_automated_feedback('final')}</td>
-          </tr>
-          <tr>
-            <th>Human Feedback</th>
-            <td colspan="3">{self.human_feedback}</td>
-          </tr>
-        """
-
-    def __str__(self):
-        return f"""
-        <table>
-          <caption><h3>{self.name}</h3></caption>
-          <tr>
-            <th>Total Score: {self.get_total_score()}</th>
-            <th>Timestamp</th>
-            <th>Submission ID</th>
-            <th>Request an 'Oopsie'</th>
-          </tr>
-          {self.body()}
-        </table>
-        <br>
-        """
-
-
-def get_asmt_oopsieness(oops, cur_assignment, initial_due):
-    if oops and oops.assignment == cur_assignment:
+             < self.row.initial_due_date)):
+            return
+        yield peer_review_head
+        if self.row.peer1:
+            yield from self.gradeable_row(self.row.peer1 + ' Peer Review', 'review1', self.review1_grade if self.review1_grade else '-')
+        if self.row.peer2:
+            yield from self.gradeable_row(self.row.peer2 + ' Peer Review', 'review2', self.review2_grade if self.review2_grade else '-')
+        yield from self.gradeable_row('Final Submission', 'final', self.final_grade if self.final_grade else '-')
+        yield from self.feedback_row('Automated Feedback', self.get_automated_feedback('final'))
+        yield from self.feedback_row('Human Feedback', self.human_feedback)
+
+    def render(self):
+        return asmt_table.render(name=self.name,
+                                 total_score=self.get_total_score(),
+                                 body=self.body())
+
+
+def get_asmt_oopsieness(oopsie, cur_assignment, initial_due):
+    if oopsie == cur_assignment:
         return OopsStatus.USED_HERE
     if initial_due < int(datetime.now().timestamp()):
         return OopsStatus.PAST_DUE
-    if oops:
+    if oopsie:
         return OopsStatus.UNAVAILABLE
     return OopsStatus.AVAILABLE
 
 
+def dashboard_query(username):
+    dash_tbl = db.DashboardRow
+    return (dash_tbl.select()
+            .where(dash_tbl.user == username)
+            .order_by(dash_tbl.initial_due_date, dash_tbl.id))
+
+
+def load_dashboard(username):
+    return list(dashboard_query(username).namedtuples())
+
+
+# Summarize everything the dashboard of a user is rendered from
+# so that an unchanged one can be recognized without rendering it again
+def dashboard_version(rows):
+    # what is shown also changes as due dates pass
+    now = int(datetime.now().timestamp())
+    passed = [(row.initial_due_date < now, row.initial_due_date <= now,
+               row.final_due_date <= now) for row in rows]
+    gitnotes.grading.refresh()
+    return rows, passed, gitnotes.grading.version()
+
+
+oopsie_confirm = templates.Template("""
+                <h2>Are you sure?</h2>
+                <p>You get only one oopsie during the whole semester.
+                Are you sure that you want to use it on {assignment}?</p>
+                <form method="post" action="/dashboard">
+                <input type="hidden" name="oopsie" value="{assignment}">
+                <button type="submit" formmethod="get">Cancel</button>
+                <button type="submit" name="confirm" value="y">Confirm</button>
+                <br><br>
+                </form>
+            """)
+
+
 def handle_dashboard(rocket):
     if not rocket.session:
         return rocket.raw_respond(HTTPStatus.FORBIDDEN)
+    username = rocket.session.username
     asmt_tbl = denis.db.Assignment
-    if rocket.method != 'GET':
+    if rocket.method == 'GET':
+        rows = load_dashboard(username)
+        rocket.headers += [('Cache-Control', 'private, no-cache')]
+        if rocket.not_modified(mk_etag(*dashboard_version(rows),
+                                       rocket.username, config.version_info)):
+            return rocket.raw_respond(HTTPStatus.NOT_MODIFIED)
+    else:
         if not (asn := rocket.body_args_query('oopsie')):
             return rocket.raw_respond(HTTPStatus.BAD_REQUEST)
         if not (asn_entry := asmt_tbl.get_or_none(asmt_tbl.name == asn)):
@@ -609,76 +1057,50 @@ def handle_dashboard(rocket):
         if (now := datetime.now().timestamp()) > asn_entry.initial_due_date:
             return rocket.raw_respond(HTTPStatus.BAD_REQUEST)
         if not rocket.body_args_query('confirm'):
-            return rocket.respond(f'''
-                <h2>Are you sure?</h2>
-                <p>You get only one oopsie during the whole semester.
-                Are you sure that you want to use it on {asn}?</p>
-                <form method="post" action="/dashboard">
-                <input type="hidden" name="oopsie" value="{asn}">
-                <button type="submit" formmethod="get">Cancel</button>
-                <button type="submit" name="confirm" value="y">Confirm</button>
-                <br><br>
-                </form>
-            ''', 'Are you sure?')
+            return rocket.respond_chunks(
+                [templates.render(oopsie_confirm, assignment=asn)],
+                'Are you sure?')
+        dash_tbl = db.DashboardRow
         try:
-            db.Oopsie.create(user=rocket.session.username, assignment=asn,
-                             timestamp=int(now))
+            with db.DB.atomic():
+                db.Oopsie.create(user=username, assignment=asn,
+                                 timestamp=int(now))
+                (dash_tbl.update({dash_tbl.oopsie: asn})
+                 .where(dash_tbl.user == username)
+                 .execute())
         except db.peewee.IntegrityError:
             return rocket.raw_respond(HTTPStatus.BAD_REQUEST)
-    oops_tbl = db.Oopsie
-    oops = oops_tbl.get_or_none(oops_tbl.user == rocket.session.username)
-    peer_tbl = denis.db.PeerReviewAssignment
-    peer_asns = (peer_tbl.select()
-                         .where(peer_tbl.reviewer == rocket.session.username))
-    grd_tbl = mailman.db.Gradeable
-    user_gradeables = (grd_tbl.select()
-                       .where(grd_tbl.user == rocket.session.username)
-                       .order_by(-grd_tbl.timestamp))
-    assignments = asmt_tbl.select().order_by(asmt_tbl.initial_due_date)
-    ret = '<form method="post" action="/dashboard">'
-    for assignment in assignments:
-        oopsieness = get_asmt_oopsieness(oops, assignment.name,
-                                         assignment.initial_due_date)
-        peers = (peer_asns.where(peer_tbl.assignment == assignment.name)
-                          .first())
-        peer1 = peers.reviewee1 if peers else None
-        peer2 = peers.reviewee2 if peers else None
-        asn_gradeables = (user_gradeables
-                          .where(grd_tbl.assignment == assignment.name))
-        init = asn_gradeables.where(grd_tbl.component == 'initial').first()
-        rev1 = asn_gradeables.where(grd_tbl.component == 'review1').first()
-        rev2 = asn_gradeables.where(grd_tbl.component == 'review2').first()
-        final = asn_gradeables.where(grd_tbl.component == 'final').first()
-
-        repo = git.Repo('/var/lib/git/grading.git')
-        grades = {}
-        for component in ['review1', 'review2', 'final']:
-            tag = f'{assignment.name}_{component}_{rocket.session.username}'
-            try:
-                grades[component] = repo.git.execute(['git', 'notes', '--ref=grade', 'show', tag])
-            except git.GitCommandError:
-                grades[component] = None
+        rows = load_dashboard(username)
+    gitnotes.grading.refresh()
 
-        tag = f'{assignment.name}_final_{rocket.session.username}'
-        try:
-            human_feedback = repo.git.execute(['git', 'notes', '--ref=feedback', 'show', tag])
-        except git.GitCommandError:
-            human_feedback = '-'
+    def tables():
+        yield b'<form method="post" action="/dashboard">'
+        for row in rows:
+            oopsieness = get_asmt_oopsieness(row.oopsie, row.assignment,
+                                             row.initial_due_date)
+            grades = {component: gitnotes.grading.lookup('grade', f'{row.assignment}_{component}_{username}')
+                      for component in ['review1', 'review2', 'final']}
+            human_feedback = gitnotes.grading.lookup('feedback', f'{row.assignment}_final_{username}') or '-'
 
-        ret += str(AsmtTable(assignment, oopsieness, peer1, peer2, init,
-                             rev1, grades['review1'], rev2, grades['review2'], final, grades['final'], human_feedback))
-    return rocket.respond(ret + '</form>', 'Dashboard')
+            yield from AsmtView(row, oopsieness, grades['review1'],
+                                grades['review2'], grades['final'], human_feedback).render()
+        yield b'</form>'
+    return rocket.respond_chunks(tables(), 'Dashboard')
 
 
 def find_creds_for_registration(student_id):
+    unregistered = ((db.User.student_id == student_id) &
+                    db.User.pwdhash.is_null())
+    # don't spend a bcrypt hash on ids that can't register
+    if not db.User.select().where(unregistered).exists():
+        return None
+
     password = secrets.token_urlsafe(nbytes=config.num_bytes_entropy_for_pw)
-    salt = bcrypt.gensalt()
-    pwdhash = bcrypt.hashpw(password.encode(), salt).decode()
+    pwdhash = bcryptd.hashpw(password)
 
     query = (db.User
              .update({db.User.pwdhash: pwdhash})
-             .where((db.User.student_id == student_id) &
-                    db.User.pwdhash.is_null())
+             .where(unregistered)
              .returning(db.User))
     if (user := next(iter(query.execute()), None)):
         return user.username, password
@@ -686,14 +1108,23 @@ def find_creds_for_registration(student_id):
     return None
 
 
-def handle_register(rocket):
-    def form_respond():
-        return rocket.respond('''
+register_form = templates.Template("""
     <form id="register" method="post" action="/register">
         <label for="student_id">Student ID:</label>
         <input name="student_id" type="text" id="student_id" /><br />
         <button type="submit">Submit</button>
-    </form>''', 'Register')
+    </form>""")
+
+registered_page = templates.Template("""
+    <h1>Save these credentials, you will not be able to access them again</h1><br>
+    <h3>Username: {username}</h3><br>
+    <h3>Password: {password}</h3><br>""")
+
+
+def handle_register(rocket):
+    def form_respond():
+        return rocket.respond_chunks([templates.render(register_form)],
+                                     'Register')
 
     if rocket.method != 'POST':
         return form_respond()
@@ -705,10 +1136,10 @@ def handle_register(rocket):
         return form_respond()
     username, password = creds
     rocket.msg('welcome to the classroom')
-    return rocket.respond(f'''
-    <h1>Save these credentials, you will not be able to access them again</h1><br>
-    <h3>Username: {username}</h3><br>
-    <h3>Password: {password}</h3><br>''', 'Welcome to the classroom')
+    return rocket.respond_chunks(
+        [templates.render(registered_page, username=username,
+                          password=password)],
+        'Welcome to the classroom')
 
 
 def extract_basic_auth(rocket):
@@ -722,78 +1153,129 @@ def extract_basic_auth(rocket):
     return username, password
 
 
-def determine_cache_entry(cred_str):
-    import hashlib
-    import time
-    hasher = hashlib.sha256()
-    hasher.update(cred_str)
-    hasher.update(str(int(time.time())).encode())
-    return hasher.digest()
-
-
 def http_basic_auth(rocket):
-    import authcache
     if not (creds := extract_basic_auth(rocket)):
         return
     username, password = creds
-    cache_entry = determine_cache_entry((':'.join(creds)).encode())
-    if authcache.entry_exists(cache_entry):
-        return True
-    if not check_credentials(username, password):
-        return
-    authcache.add_entry(cache_entry)
-    return True
+    return check_credentials(username, password, rocket.source)
 
 
-def handle_cgit(rocket):
-    if not rocket.session:
-        if (not (agent := rocket.env.get('HTTP_USER_AGENT'))
-           or not agent.startswith('git/')):
-            return rocket.raw_respond(HTTPStatus.FORBIDDEN)
-        if not http_basic_auth(rocket):
-            rocket.headers.append(('WWW-Authenticate', 'Basic realm="cgit"'))
-            return rocket.raw_respond(HTTPStatus.UNAUTHORIZED)
+# Why a request for cgit has to be refused, or None if it may go ahead
+def cgit_refusal(rocket):
+    if rocket.session:
+        return None
+    if (not (agent := rocket.env.get('HTTP_USER_AGENT'))
+       or not agent.startswith('git/')):
+        return HTTPStatus.FORBIDDEN
+    if not http_basic_auth(rocket):
+        rocket.headers.append(('WWW-Authenticate', 'Basic realm="cgit"'))
+        return HTTPStatus.UNAUTHORIZED
+    return None
+
+
+def mk_cgit_env(rocket):
     cgit_env = os.environ.copy()
     cgit_env['PATH_INFO'] = rocket.path_info.removeprefix('/cgit')
     cgit_env['QUERY_STRING'] = rocket.env.get('QUERY_STRING', '')
+    return cgit_env
 
-    def cgit_internal_server_error(msg):
-        print(f'cgit: Error {msg} at path_info "{cgit_env["PATH_INFO"]}"'
-              f' and query string "{cgit_env["QUERY_STRING"]}"',
-              file=sys.stderr)
-        return rocket.raw_respond(HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    proc = subprocess.Popen(['/usr/share/webapps/cgit/cgit'],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            env=cgit_env)
-    so, se = proc.communicate()
+def cgit_internal_server_error(rocket, cgit_env, msg):
+    print(f'cgit: Error {msg} at path_info "{cgit_env["PATH_INFO"]}"'
+          f' and query string "{cgit_env["QUERY_STRING"]}"',
+          file=sys.stderr)
+    return rocket.raw_respond(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
+# Respond with the output of cgit, which may be read synchronously or,
+# for the ASGI application, asynchronously
+def cgit_respond(rocket, cgit_env, output):
+    headers = output.headers
+    status = HTTPStatus.OK
     try:
-        raw_headers, raw_body = so.split(b'\n\n', maxsplit=1)
-        headers_text = raw_headers.decode()
-        headers = [tuple(line.split(': ', maxsplit=1))
-                   for line in headers_text.split('\n')]
-        raw_return = False
-        status = HTTPStatus.OK
-        if headers[0][0] == 'Status':
+        if headers and headers[0][0] == 'Status':
             status_str = headers[0][1]
             status = HTTPStatus(int(status_str.split(' ')[0]))
             if status == HTTPStatus.OK:
-                return cgit_internal_server_error('Unexpected 200 status')
-            raw_return = True
-            raw_body = b''
+                raise ValueError('Unexpected 200 status')
             del headers[0]
-        if headers[0][0] != 'Content-Type':
-            return cgit_internal_server_error('missing Content-Type')
-        if headers[0][1] != 'text/html; charset=UTF-8':
-            raw_return = True
+        if not headers or headers[0][0] != 'Content-Type':
+            raise ValueError('missing Content-Type')
+    except (ValueError, IndexError) as ex:
+        output.close()
+        return cgit_internal_server_error(rocket, cgit_env, ex)
+    if status != HTTPStatus.OK:
+        # cgit's own error pages are not passed on
+        output.close()
         rocket.headers += headers
-        if raw_return:
-            return rocket.raw_respond(status, raw_body)
-        outstring = raw_body.decode()
-        return rocket.respond(outstring, 'CGit')  # TODO: get real title? (file issue upstream)
-    except (UnicodeDecodeError, ValueError, IndexError) as ex:
-        return cgit_internal_server_error(type(ex))
+        return rocket.raw_respond(status)
+    if headers[0][1] == 'text/html; charset=UTF-8':
+        output.wrap(rocket.page_header('CGit'),  # TODO: get real title? (file issue upstream)
+                    rocket.page_footer())
+        # the length cgit gives does not count what is wrapped around it
+        output.headers = [(name, value) for name, value in output.headers
+                          if name.lower() != 'content-length']
+    rocket.headers += output.headers
+    return rocket.stream_respond(status, output)
+
+
+def handle_cgit(rocket):
+    if (refusal := cgit_refusal(rocket)):
+        return rocket.raw_respond(refusal)
+    cgit_env = mk_cgit_env(rocket)
+    try:
+        output = cgit.run(cgit_env, compress.accepts_gzip(rocket.env))
+    except (OSError, EOFError, UnicodeDecodeError, ValueError) as ex:
+        return cgit_internal_server_error(rocket, cgit_env, type(ex))
+    return cgit_respond(rocket, cgit_env, output)
+
+
+# Who a smart HTTP request is from, or None if they could not be told
+def git_http_user(rocket):
+    if (username := rocket.username):
+        return username
+    if not http_basic_auth(rocket):
+        rocket.headers.append(('WWW-Authenticate', 'Basic realm="cgit"'))
+        return None
+    username, _ = extract_basic_auth(rocket)
+    return username
+
+
+def git_http_respond(rocket, output):
+    status = HTTPStatus.OK
+    headers = output.headers
+    if headers and headers[0][0] == 'Status':
+        try:
+            status = HTTPStatus(int(headers[0][1].split(' ')[0]))
+        except ValueError:
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+        del headers[0]
+    rocket.headers += headers
+    return rocket.stream_respond(status, output)
+
+
+# Serve the smart HTTP protocol for fetches and clones of the repositories
+# cgit shows, the dumb protocol is still left to cgit
+def handle_git_http(rocket):
+    if not (username := git_http_user(rocket)):
+        return rocket.raw_respond(HTTPStatus.UNAUTHORIZED)
+    path_info = rocket.path_info.removeprefix('/cgit')
+    try:
+        output = githttp.run(rocket.env, path_info, username)
+    except (OSError, EOFError, UnicodeDecodeError, ValueError) as ex:
+        print(f'git http-backend: Error {ex!r} at path_info "{path_info}"',
+              file=sys.stderr)
+        return rocket.raw_respond(HTTPStatus.INTERNAL_SERVER_ERROR)
+    return git_http_respond(rocket, output)
+
+
+def is_git_http(rocket):
+    if not rocket.path_info.startswith('/cgit/'):
+        return False
+    if rocket.method == 'POST':
+        return rocket.path_info.endswith('/git-upload-pack')
+    return (rocket.path_info.endswith('/info/refs') and
+            rocket.queries_query('service') == 'git-upload-pack')
 
 
 def handle_containerfile(rocket):
@@ -803,7 +1285,7 @@ def handle_containerfile(rocket):
     hostname = os.getenv("HOSTNAME")
     if creds := extract_basic_auth(rocket):
         username, password = creds
-    if not creds or not check_credentials(username, password):
+    if not creds or not check_credentials(username, password, rocket.source):
         rocket.headers.append(('WWW-Authenticate', 'Basic realm="podman"'))
         return rocket.raw_respond(HTTPStatus.UNAUTHORIZED)
     tbl = db.User
@@ -900,6 +1382,9 @@ ENTRYPOINT ["/usr/bin/bash", "-l", "-i"]
 '''.encode())  # NOQA: W191 E101
 
 
+error_page = templates.Template('<h1>HTTP ERROR {code}: {name}</h1>')
+
+
 def handle_error(rocket):
     error_num_str = rocket.queries_query('num')
     try:
@@ -908,9 +1393,21 @@ def handle_error(rocket):
     except ValueError as e:
         print(f'invalid query passed to handle error {e}', file=sys.stderr)
         return rocket.raw_respond(HTTPStatus.INTERNAL_SERVER_ERROR)
-    error_description = (f'<h1>HTTP ERROR {error.value}: '
-                         f'{error.name.upper().replace("_", " ")}</h1>')
-    return rocket.respond(error_description, f'ERROR {error.value}')
+    return rocket.respond_chunks(
+        [templates.render(error_page, code=error.value,
+                          name=error.name.upper().replace('_', ' '))],
+        f'ERROR {error.value}')
+
+
+# Get the page for a document as prerender.py would have built it
+def render_md(path, stat):
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if (found := md_cache.get(key)) is None:
+        with open(path) as file:
+            page = prerender.build_page(html_header, file.read())
+        found = (page, compress.deflate_prefix(page))
+        md_cache.put(key, found)
+    return found
 
 
 def handle_try_md(rocket):
@@ -919,23 +1416,53 @@ def handle_try_md(rocket):
     path = f'{config.doc_root}{rocket.path_info}'
     if not os.access(path, os.R_OK):
         return rocket.raw_respond(HTTPStatus.NOT_FOUND)
-    with open(path) as file:
-        md = file.read()
-    html = markdown.markdown(md, extensions=['tables', 'fenced_code',
-                                             'footnotes', 'toc'])
-    # Use the first line of the document as the title, sans #
-    if (title_end := md.find('\n')) != -1:
-        title = md[0:title_end].lstrip('#').strip()
-    else:
-        title = 'KDLP'
-    return rocket.respond(html, title)
+    stat = os.stat(path)
+    gzip = compress.accepts_gzip(rocket.env)
+    # the page footer names the user, so their copy is theirs alone
+    etag = mk_etag(path, stat.st_mtime_ns, stat.st_size, rocket.username,
+                   config.version_info, gzip)
+    rocket.headers += [('Cache-Control', 'private, no-cache'),
+                       ('Vary', 'Accept-Encoding')]
+    if rocket.not_modified(etag, stat.st_mtime):
+        return rocket.raw_respond(HTTPStatus.NOT_MODIFIED)
+    if (page := prerender.load(rocket.path_info, stat, gzip)) is None:
+        page, deflated = render_md(path, stat)
+        page = deflated if gzip else page
+    return rocket.respond_prerendered(page, gzip)
+
+
+# Raised while checking credentials when the server is too busy to do it
+BUSY = (bcryptd.Saturated, ratelimit.Limited)
+
+
+def busy_respond(rocket, ex):
+    if isinstance(ex, ratelimit.Limited):
+        rocket.headers += [('Retry-After', str(math.ceil(ex.wait)))]
+        return rocket.raw_respond(HTTPStatus.TOO_MANY_REQUESTS)
+    rocket.headers += [('Retry-After', '1')]
+    return rocket.raw_respond(HTTPStatus.SERVICE_UNAVAILABLE)
+
+
+def radius_application(env, SR):
+    rocket = Rocket(env, SR)
+    try:
+        return dispatch(rocket)
+    except BUSY as ex:
+        return busy_respond(rocket, ex)
 
 
-def application(env, SR):
-    rocket = Rocket(env, SR)
+application = compress.GzipMiddleware(radius_application,
+                                      config.compress_min_bytes,
+                                      config.compress_level)
+
+
+def dispatch(rocket):
     if rocket.method != 'GET' and rocket.method != 'POST':
         return rocket.raw_respond(HTTPStatus.METHOD_NOT_ALLOWED)
 
+    if is_git_http(rocket):
+        return handle_git_http(rocket)
+
     # routes supporting get and post
     match rocket.path_info:
         case '/login':
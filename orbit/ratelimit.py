@@ -0,0 +1,117 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import config
+
+# Token buckets shared by every radius worker through a mmap'd file
+#
+# Each slot holds a bucket as (key digest, tokens, last update time) and a
+# key lives in one of a few consecutive slots after the one its digest
+# picks. Slots are locked with POSIX record locks, so workers only contend
+# when they touch the same neighbourhood of the table.
+
+_slot = struct.Struct('16sdd')
+_probe = 8
+
+
+class Limited(Exception):
+    """
+    Limited: Raised instead of checking a password when one of the
+             buckets it would be charged to is empty
+
+    ...
+
+    Attributes
+    ----------
+
+    wait : float
+        Seconds until the next attempt would be allowed
+
+    """
+
+    def __init__(self, wait):
+        super().__init__(f'rate limited for {wait:.1f}s')
+        self.wait = wait
+
+
+class _table:
+    lock = threading.Lock()
+    pid = None
+    fd = None
+    map = None
+
+
+def _open():
+    # mappings are shared across fork, but the lock owner is the process
+    if _table.pid == os.getpid():
+        return
+    size = _slot.size * config.ratelimit_slots
+    fd = os.open(config.ratelimit_file, os.O_RDWR | os.O_CREAT, 0o600)
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    _table.fd = fd
+    _table.map = mmap.mmap(fd, size)
+    _table.pid = os.getpid()
+
+
+def _take(key, rate, burst, now, cost=1):
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], 'little') % (config.ratelimit_slots - _probe)
+    start, length = first * _slot.size, _probe * _slot.size
+    fcntl.lockf(_table.fd, fcntl.LOCK_EX, length, start)
+    try:
+        # use the key's own slot if it has one, otherwise take over
+        # whichever slot in the neighbourhood was used least recently
+        offset, tokens, oldest = None, burst, None
+        for i in range(first, first + _probe):
+            slot_key, slot_tokens, updated = _slot.unpack_from(
+                _table.map, i * _slot.size)
+            if slot_key == digest:
+                offset = i * _slot.size
+                tokens = min(burst, slot_tokens + (now - updated) * rate)
+                break
+            if oldest is None or updated < oldest:
+                offset, oldest = i * _slot.size, updated
+        if tokens < 1:
+            return (1 - tokens) / rate
+        _slot.pack_into(_table.map, offset, digest, tokens - cost, now)
+        return 0
+    finally:
+        fcntl.lockf(_table.fd, fcntl.LOCK_UN, length, start)
+
+
+# The bucket of a user is kept per client, so that the failures of whoever
+# is guessing a password never lock the user out from anywhere else
+def _user_key(username, source):
+    return f'user:{username}:{source or ""}'
+
+
+# Check an attempt against the user's bucket and charge it to the client's
+# when it is known, the user's is only charged by failed()
+# nginx proxies every request so the peer address is always nginx itself,
+# only a client address that nginx forwards in a header is worth limiting
+def throttle(username, source=None):
+    now = time.time()
+    with _table.lock:
+        _open()
+        if (wait := _take(_user_key(username, source),
+                          config.ratelimit_user_rate,
+                          config.ratelimit_user_burst, now, cost=0)):
+            raise Limited(wait)
+        if source and not source.startswith('unix:') and (
+                wait := _take(f'source:{source}', config.ratelimit_source_rate,
+                              config.ratelimit_source_burst, now)):
+            raise Limited(wait)
+
+
+# Charge a wrong password to the user's bucket, a right one costs nothing
+def failed(username, source=None):
+    with _table.lock:
+        _open()
+        _take(_user_key(username, source), config.ratelimit_user_rate,
+              config.ratelimit_user_burst, time.time())
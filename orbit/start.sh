@@ -1,4 +1,5 @@
 #!/bin/sh
+./db.py || exit 1
 memcached --daemon --unix-socket /run/orbit/memcached.sock
 uwsgi --master --plugin 'python,http' ./radius.ini &
 trap 'kill -INT $!' TERM
@@ -0,0 +1,91 @@
+import html
+import string
+
+# bytes collected before a chunk is handed on by buffered()
+CHUNK_SIZE = 8 * 1024
+
+
+class Markup(str):
+    """
+    Markup: Text that is already HTML, inserted into templates as it is
+            rather than escaped like any other string
+    """
+
+
+class Template:
+    """
+    Template: HTML with {name} fields that renders to a stream of bytes
+              The source is split into encoded literals and fields once
+              when the template is made, so rendering is only a walk over
+              the parts. Values are escaped unless they are Markup, bytes
+              (output that was already rendered) or an iterable of values,
+              such as another template's render(), which is spliced in
+
+    ...
+
+    Attributes
+    ----------
+
+    fields : set
+        The names of the fields in the template
+
+    Methods
+    -------
+
+    render(**values) : generator
+        Yield the template as bytes with each field filled in from values
+
+    """
+
+    def __init__(self, source):
+        self._parts = []
+        for literal, name, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                self._parts.append(literal.encode())
+            if name is not None:
+                if conversion:
+                    raise ValueError(f'conversions are not supported: {name}')
+                self._parts.append((name, spec))
+        self.fields = {part[0] for part in self._parts
+                       if isinstance(part, tuple)}
+
+    def render(self, **values):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                name, spec = part
+                yield from _chunks(values[name], spec)
+
+
+def _chunks(value, spec=''):
+    if isinstance(value, Markup):
+        yield value.encode()
+    elif isinstance(value, bytes):
+        yield value
+    elif isinstance(value, str):
+        yield html.escape(format(value, spec)).encode()
+    elif hasattr(value, '__iter__'):
+        for item in value:
+            yield from _chunks(item)
+    else:
+        yield html.escape(format(value, spec)).encode()
+
+
+def render(template, **values):
+    return b''.join(template.render(**values))
+
+
+# Join the many small pieces of rendered templates into fewer bigger chunks
+# so that the server is not asked to send each one on its own
+def buffered(chunks):
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        if (size := size + len(chunk)) >= CHUNK_SIZE:
+            yield b''.join(pending)
+            pending = []
+            size = 0
+    if pending:
+        yield b''.join(pending)
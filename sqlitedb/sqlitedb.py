@@ -0,0 +1,144 @@
+import os
+import weakref
+
+import peewee
+
+# Connection settings shared by every database of every service
+#
+# With write ahead logging readers see the last committed state and are
+# never blocked by a writer, which lets mailman and denis record results
+# while radius is serving pages from the same files. NORMAL synchronous
+# is durable across application crashes in WAL mode, only a power loss
+# can lose the latest transactions, and it no longer syncs every commit.
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    # bytes of the database read through a memory map instead of read()
+    'mmap_size': 64 * 1024 * 1024,
+    # negative means KiB rather than pages
+    'cache_size': -8 * 1024,
+    # milliseconds a writer waits for another writer before giving up
+    'busy_timeout': 5000,
+}
+
+
+class Database(peewee.SqliteDatabase):
+    """
+    Database: A peewee SqliteDatabase opened with PRAGMAS
+              Each thread keeps its connection open between queries rather
+              than reconnecting, and each process gets its own: one opened
+              before a fork is left to the parent instead of being shared
+
+    ...
+
+    Attributes
+    ----------
+
+    path : string
+        Location of the database file
+
+    """
+
+    def __init__(self, path, **pragmas):
+        super().__init__(path, pragmas={**PRAGMAS, **pragmas})
+        self.path = path
+        self._inherited = []
+        # peewee reaches the connection by several paths, cursor() and
+        # execute_sql() among them, so the child is dealt with as it forks
+        # rather than in any one of them
+        database = weakref.ref(self)
+        os.register_at_fork(
+            after_in_child=lambda: (db := database()) and db._forked())
+
+    def _forked(self):
+        # closing a connection the parent still uses can release its locks,
+        # so it is only forgotten and kept from being collected
+        if not self.is_closed():
+            self._inherited.append(self._state.conn)
+        self._state.reset()
+
+
+class Attached:
+    """
+    Attached: The models of several databases read through one connection
+              The other databases are ATTACHed to the main one, and every
+              model of each is bound to its schema by a subclass, so
+              queries can join tables of different files in one statement
+              and use the indexes of all of them
+              The connection is query only unless writable is true, in
+              which case writes through it to several of the databases
+              can be made in one transaction
+
+    ...
+
+    Attributes
+    ----------
+
+    database : Database
+        The connection with the other databases attached
+
+    <model name> : Model
+        Each model of every database, e.g. Attached(...).Gradeable
+
+    """
+
+    def __init__(self, main, writable=False, **schemas):
+        self.database = Database(main.DB.path, query_only=int(not writable))
+        for schema, module in schemas.items():
+            self.database.attach(module.DB.path, schema)
+        for schema, module in [(None, main), *schemas.items()]:
+            for model in module.BaseModel.__subclasses__():
+                setattr(self, model.__name__, self._bind(model, schema))
+
+    def _bind(self, model, schema):
+        meta = type('Meta', (), {'database': self.database,
+                                 'schema': schema,
+                                 'table_name': model._meta.table_name})
+        return type(model.__name__, (model,),
+                    {'Meta': meta, '__module__': model.__module__})
+
+
+# Keep a database open for as long as the process runs
+#
+# Services that only read a database mount it read-only, where sqlite
+# cannot create the -wal and -shm files every reader of a WAL database
+# needs. Those exist while any connection to the database is open and are
+# removed by the last one to close, so the service that writes a database
+# holds it open from when it starts.
+def hold(database):
+    database.connect(reuse_if_open=True)
+
+
+# Bring a database up to date with the models it is used through
+#
+# migrations is every change ever made to the schema after it was first
+# deployed, in order, and PRAGMA user_version counts how many of them the
+# database has had applied. A database without any tables is created from
+# the models as they are now, which already includes all of them.
+def migrate(database, models, migrations):
+    with database.atomic():
+        version = database.pragma('user_version')
+        if version > len(migrations):
+            raise RuntimeError(f'{database.path} is at schema version '
+                               f'{version}, newer than this code knows')
+        if version == 0 and not database.get_tables():
+            database.create_tables(models)
+        else:
+            for migration in migrations[version:]:
+                migration()
+        database.pragma('user_version', len(migrations))
+    return version, len(migrations)
+
+
+# Get the plan sqlite picks for a query as lines of text, one per step,
+# indented below the step they are part of like the sqlite3 shell does
+def explain(query):
+    sql, params = query.sql()
+    database = query.model._meta.database
+    depth = {0: -1}
+    lines = []
+    for step, parent, _, detail in database.execute_sql(
+            f'EXPLAIN QUERY PLAN {sql}', params):
+        depth[step] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[step] + detail)
+    return lines
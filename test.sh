@@ -80,6 +80,47 @@ curl --url "https://$SINGULARITY_HOSTNAME/login" \
   | tee test/login_success \
   | grep "msg = user authenticated by password"
 
+# Check that a login target carrying HTML comes back in the form escaped
+curl --url "https://$SINGULARITY_HOSTNAME/login" \
+  --unix-socket ./socks/https.sock \
+  "${CURL_OPTS[@]}" \
+  --get \
+  --data-urlencode 'target="><script>alert(1)</script>' \
+  | tee test/login_target_escaped \
+  | grep -F 'action="/login?target=%22%3E%3Cscript%3Ealert%281%29%3C%2Fscript%3E"'
+
+# Check that logging out ends the session and expires the cookie with a
+# single header, and that the login page it leads to sends no more of them
+curl --url "https://$SINGULARITY_HOSTNAME/login" \
+  --unix-socket ./socks/https.sock \
+  "${CURL_OPTS[@]}" \
+  --cookie-jar test/cookies_logout \
+  --data "username=user&password=${REGISTER_PASS}" \
+  | grep "msg = user authenticated by password"
+
+for page in logout login; do
+  curl --url "https://$SINGULARITY_HOSTNAME/$page" \
+    --unix-socket ./socks/https.sock \
+    "${CURL_OPTS[@]}" \
+    --cookie test/cookies_logout \
+    --include \
+    | tee "test/${page}_after_logout" \
+    | grep -i '^set-cookie:' \
+    | tr -d '\r' \
+    | diff <(echo 'auth=; Max-Age=0; Path=/') <(cut -d ' ' -f 2-)
+done
+
+curl --url "https://$SINGULARITY_HOSTNAME/dashboard" \
+  --unix-socket ./socks/https.sock \
+  --verbose \
+  --cacert test/ca_cert.pem \
+  --no-progress-meter \
+  --cookie test/cookies_logout \
+  --output /dev/null \
+  --write-out '%{http_code}\n' \
+  | tee test/dashboard_after_logout \
+  | grep -x 403
+
 # Check that the user can get the empty list of email on the server
 curl --url "pop3s://$SINGULARITY_HOSTNAME" \
   --unix-socket ./socks/pop3s.sock \
@@ -184,4 +225,244 @@ curl --url "https://$SINGULARITY_HOSTNAME/_matrix/client/r0/login" \
   | tee test/matrix_login_invalid \
   | grep '{"errcode":"M_FORBIDDEN","error":"Invalid username or password"}'
 
+# Check that the dashboard can be read while mailman holds a write transaction
+curl --url "https://$SINGULARITY_HOSTNAME/login" \
+  --unix-socket ./socks/https.sock \
+  "${CURL_OPTS[@]}" \
+  --cookie-jar test/cookies \
+  --data "username=user&password=${REGISTER_PASS}" \
+  | grep "msg = user authenticated by password"
+
+${PODMAN_COMPOSE} exec mailman python3 -c '
+import time
+import db
+import orbit.db
+with db.DB.atomic("EXCLUSIVE"), orbit.db.DB.atomic("EXCLUSIVE"):
+    print("holding", flush=True)
+    time.sleep(5)
+' > test/write_lock_holder &
+WRITER=$!
+timeout 30 bash -c 'until grep -q holding test/write_lock_holder; do sleep 0.1; done'
+
+curl --url "https://$SINGULARITY_HOSTNAME/dashboard" \
+  --unix-socket ./socks/https.sock \
+  "${CURL_OPTS[@]}" \
+  --cookie test/cookies \
+  --max-time 2 \
+  | tee test/dashboard_during_write \
+  | grep 'action="/dashboard"'
+
+wait "$WRITER"
+
+# Check that a process forked after a query, as uWSGI forks its workers,
+# opens its own sqlite connection instead of sharing the parent's
+${PODMAN_COMPOSE} exec orbit python3 -c '
+import os
+import db
+db.User.select().count()
+parent = db.DB._state.conn
+pid = os.fork()
+if pid == 0:
+    fresh = db.DB.is_closed()
+    db.User.select().count()
+    os._exit(0 if fresh and db.DB._state.conn is not parent else 1)
+_, status = os.waitpid(pid, 0)
+print("fresh" if status == 0 else "shared")
+' | tee test/fork_connection \
+  | grep -x fresh
+
+# Check that radius serves cgit under uvicorn through asgi.py, and that a
+# cgit process is stopped once the client waiting on it has hung up
+${PODMAN_COMPOSE} exec orbit python3 -c '
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+
+# cgit, except that a page asked for with ?hang never finishes
+with open("/tmp/cgit", "w") as script:
+    script.write("""#!/usr/bin/env python3
+import os
+import sys
+import time
+if "hang" not in os.environ["QUERY_STRING"]:
+    os.execv("/usr/share/webapps/cgit/cgit", ["cgit"])
+with open("/tmp/cgit.pid", "w") as file:
+    file.write(str(os.getpid()))
+sys.stdout.write("Content-Type: text/html\\n\\nhanging")
+sys.stdout.flush()
+time.sleep(300)
+""")
+os.chmod("/tmp/cgit", 0o755)
+server = subprocess.Popen([sys.executable, "-c", """
+import cgit
+import config
+import uvicorn
+cgit.CGIT = "/tmp/cgit"
+config.cgit_cache_max_bytes = 0
+uvicorn.run("asgi:application", host="127.0.0.1", port=9099,
+            timeout_graceful_shutdown=5)
+"""])
+try:
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", 9099)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    conn = http.client.HTTPConnection("127.0.0.1", 9099)
+    conn.request("POST", "/login",
+                 urllib.parse.urlencode({"username": sys.argv[1],
+                                         "password": sys.argv[2]}),
+                 {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    cookie = [value for name, value in response.getheaders()
+              if name.lower() == "set-cookie"][-1].split(";")[0]
+    conn.request("GET", "/cgit/", headers={"Cookie": cookie})
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert f"whoami = {sys.argv[1]}<".encode() in response.read()
+    with socket.create_connection(("127.0.0.1", 9099)) as sock:
+        sock.sendall(f"GET /cgit/?hang HTTP/1.1\r\nHost: orbit\r\n"
+                     f"Cookie: {cookie}\r\n\r\n".encode())
+        received = b""
+        while b"hanging" not in received:
+            received += sock.recv(65536)
+        with open("/tmp/cgit.pid") as file:
+            pid = int(file.read())
+    for _ in range(100):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            print("stopped")
+            break
+        time.sleep(0.1)
+finally:
+    server.terminate()
+    server.wait()
+' user "${REGISTER_PASS}" \
+  | tee test/asgi_cgit \
+  | grep -x stopped
+
+# Check that the page of a cgit that fails part way through is not cached
+${PODMAN_COMPOSE} exec orbit python3 -c '
+import os
+import cgit
+import config
+
+with open("/tmp/cgit-fail", "w") as script:
+    script.write("""#!/usr/bin/env python3
+import sys
+sys.stdout.write("Content-Type: text/html\\n\\n<p>partial")
+sys.exit(1)
+""")
+os.chmod("/tmp/cgit-fail", 0o755)
+cgit.CGIT = "/tmp/cgit-fail"
+config.cgit_backend = "popen"
+env = {"PATH_INFO": "/", "QUERY_STRING": f"failing={os.getpid()}"}
+output = cgit.run(env)
+assert b"".join(output) == b"<p>partial"
+output.close()
+print("cached" if cgit.lookup(env)[1] else "not cached")
+' | tee test/cgit_failure_cache \
+  | grep -x "not cached"
+
+# Check that someone guessing the password of a user until they are rate
+# limited does not keep the user from logging in from elsewhere
+orbit/warpdrive.sh -u victim -p victimpass -n
+${PODMAN_COMPOSE} exec orbit python3 -c '
+import radius
+import ratelimit
+for attempt in range(30):
+    try:
+        radius.check_credentials("victim", f"guess{attempt}", "192.0.2.1")
+    except ratelimit.Limited:
+        break
+else:
+    raise SystemExit("never rate limited")
+print(radius.check_credentials("victim", "victimpass", "192.0.2.2"))
+' | tee test/ratelimit_victim \
+  | grep -x True
+
+# Check that mailman records a gradeable together with its dashboard row,
+# and rebuilds the dashboard when orbit.db stays locked past busy_timeout
+${PODMAN_COMPOSE} exec denis python3 -c '
+import time
+import db
+now = int(time.time())
+db.Assignment.create(name="atomic", initial_due_date=now + 600,
+                     peer_review_due_date=now + 1200,
+                     final_due_date=now + 1800)
+'
+
+${PODMAN_COMPOSE} exec mailman python3 -c '
+import time
+import orbit.db
+with orbit.db.DB.atomic("EXCLUSIVE"):
+    print("holding", flush=True)
+    time.sleep(8)
+' > test/dashboard_lock_holder &
+HOLDER=$!
+timeout 30 bash -c 'until grep -q holding test/dashboard_lock_holder; do sleep 0.1; done'
+
+${PODMAN_COMPOSE} exec mailman python3 -c '
+import time
+import db
+import denis.db
+import orbit.db
+import submit
+now = int(time.time())
+asn = denis.db.Assignment.get(name="atomic")
+for sid in ["atomic_locked", "atomic_free"]:
+    submit.record_gradeable(asn, "user", "initial", sid, now, "ok.")
+    gradeables = db.Gradeable.select().where(db.Gradeable.submission_id == sid)
+    row = orbit.db.DashboardRow.get(user="user", assignment="atomic")
+    print(gradeables.count(), row.initial_id == sid)
+' | tee test/dashboard_atomic \
+  | diff <(printf '1 True\n1 True\n') /dev/stdin
+
+wait "$HOLDER"
+
+# Check that authcache fetches several entries in one round trip and
+# counts the hits and misses among them
+${PODMAN_COMPOSE} exec orbit python3 -c '
+import authcache
+authcache.add_entry(b"multi_a", b"1", 60)
+authcache.add_entry(b"multi_b", b"", 60)
+found = authcache.get_entries([b"multi_a", b"multi_b", b"multi_c"])
+counts = authcache.stats()
+print(sorted(found.items()), counts["hits"], counts["misses"])
+' | tee test/authcache_multi \
+  | grep -xF "[(b'multi_a', b'1'), (b'multi_b', b'')] 2 1"
+
+# Check that concurrent requests from different users are each answered
+# correctly and for the right user by the threads of radius
+curl --url "https://$SINGULARITY_HOSTNAME/login" \
+  --unix-socket ./socks/https.sock \
+  "${CURL_OPTS[@]}" \
+  --cookie-jar test/cookies_resu \
+  --data "username=resu&password=ssap" \
+  | grep "msg = user authenticated by password"
+
+for i in $(seq 64); do
+  if [ $((i % 2)) -eq 0 ]; then who=user; jar=test/cookies; else who=resu; jar=test/cookies_resu; fi
+  for page in dashboard activity; do
+    curl --url "https://$SINGULARITY_HOSTNAME/$page" \
+      --unix-socket ./socks/https.sock \
+      "${CURL_OPTS[@]}" \
+      --cookie "$jar" \
+      --max-time 30 \
+      --output "test/stress_${page}_${i}_${who}" &
+  done
+done
+wait
+for file in test/stress_*; do
+  grep -q "whoami = ${file##*_}<" "$file"
+done
+test "$(find test -name 'stress_*' | wc -l)" -eq 128
+
 echo "ALL TESTS PASS"